@@ -29,19 +29,44 @@
 #                          - make use of EVT_CLIENT_AUTH in order to retrieve the correct client level
 # 01/06/2015 - 1.6 - Fenix - added compatibility with Frostbite games
 # 05/05/2016 - 1.7 - Fenix - fix invalid server group split in group message broadcast
+# 19/10/2026 - 1.8 - Fenix - keep a cached view of the staff connected to the Teamspeak 3 server
+#                          - retrieve server groups using 'clientlist -groups' instead of one 'clientinfo' per client
+#                          - added optional capture of the server query traffic (replayed by the test suite)
+#                          - added command !calladminprofile: profile plugin handlers on demand
+#                          - resolve the server hostname lazily and refresh it in the background
+#                          - added command !calladminreload: reload the configuration without restarting B3
+#                          - send admin requests over a persistent server query session
+#                          - added support for multiple Teamspeak 3 servers (notified in parallel)
+#                          - added channel and poke delivery modes (recipients are sent pipelined commands)
+#                          - added reason categories: requests are classified and routed according to their reason
+#                          - attach recent activity of the reporter and of the reported players to admin requests
+#                          - staff can reply !ack or !dismiss on Teamspeak 3 to resolve admin requests
+#                          - added periodic admin requests digest (built from rolling counters)
 
 __author__ = 'Fenix'
-__version__ = '1.7'
+__version__ = '1.8'
 
 import b3
 import b3.plugin
 import b3.events
+import b3.cron
+import b3.config
 import telnetlib
 import thread
+import threading
+import functools
+import cProfile
+import pstats
+import json
 import time
+import bisect
+import math
 import re
 
+from collections import deque
+from collections import OrderedDict
 from ConfigParser import NoOptionError
+from StringIO import StringIO
 
 try:
     # import the getCmd function
@@ -60,6 +85,7 @@ try:
     import b3.extplugins.ircbot.colors.GREEN as GREEN
     import b3.extplugins.ircbot.colors.MAGENTA as MAGENTA
     import b3.extplugins.ircbot.colors.ORANGE as ORANGE
+    import b3.extplugins.ircbot.colors.RED as RED
     import b3.extplugins.ircbot.colors.RESET as RESET
     import b3.extplugins.ircbot.functions.convert_colors as convert_colors
 except ImportError:
@@ -69,6 +95,7 @@ except ImportError:
     GREEN = "\x0303"
     MAGENTA = "\x0313"
     ORANGE = "\x0307"
+    RED = "\x0304"
     RESET = "\x0F\x02"
     convert_colors = lambda x: x
 
@@ -77,32 +104,106 @@ class CalladminPlugin(b3.plugin.Plugin):
 
     adminPlugin = None
     adminRequest = None
+    # admin request acknowledged on Teamspeak 3 (kept until an admin shows up)
+    ackRequest = None
+    # admin request resolved on Teamspeak 3 (kept for the treshold check)
+    resolvedRequest = None
+    # time of the last admin request of each reason category
+    categoryRequests = None
     ircbotPlugin = None
 
-    # set according to configuration value
-    send_teamspeak_message = None
+    # Teamspeak 3 servers receiving admin requests (each one with its own server query session)
+    targets = []
+    presenceCrontab = None
+
+    # recent activity of the players (fed by game events)
+    activity = None
+
+    # admin requests statistics (kept across configuration reloads) and periodic digest
+    stats = None
+    digestCrontab = None
+    lastDigest = None
+
+    # Teamspeak 3 text messages listener (replies are handled in the B3 event thread)
+    listener = None
+    replyEvent = None
+
+    # cached server hostname (with Teamspeak 3 and IRC formatted variants)
+    hostname = None
+    hostnameCrontab = None
+    # last hostname reported by the parser (many parsers set it only once, at startup)
+    gameHostname = None
+
+    # server query traffic recorder (if enabled)
+    capture = None
+
+    # handlers profiler (only while profiling is active)
+    profiler = None
+
+    # seconds to wait for Teamspeak 3 targets to be notified
+    delivery_timeout = 15
+
+    # number of activity records attached to an admin request for each player
+    activity_summary = 3
+    # maximum number of players named in the reason whose activity is attached to an admin request
+    activity_named = 3
+    # maximum length (in bytes) of a Teamspeak 3 text message
+    message_length = 1024
+
+    teams = {
+        b3.TEAM_UNKNOWN: 'unknown',
+        b3.TEAM_FREE: 'free',
+        b3.TEAM_SPEC: 'spectator',
+        b3.TEAM_RED: 'red',
+        b3.TEAM_BLUE: 'blue',
+    }
 
     patterns = {
         ## TEAMSPEAK 3 PATTERNS
         'p1': '[B][ADMIN REQUEST][/B] [B]%s [%s][/B] connected to [B]%s[/B]',
         'p2': '[B][ADMIN REQUEST][/B] [B]%s[/B] disconnected from [B]%s[/B]',
         'p3': '[B][ADMIN REQUEST][/B] [B]%s[/B] requested an admin on [B]%s[/B] : [B]%s[/B]',
+        'p4': '[B][ADMIN REQUEST][/B] [B][%s][/B] [B]%s[/B] requested an admin on [B]%s[/B] : [B]%s[/B]',
         # IRC CHANNEL PATTERNS
         'i1': '%s[%sADMIN REQUEST%s] %s%s%s [%s%s%s] connected to %s',
         'i2': '%s[%sADMIN REQUEST%s] %s%s%s disconnected from %s',
         'i3': '%s[%sADMIN REQUEST%s] %s%s%s requested an admin on %s : %s%s',
+        'i4': '%s[%sADMIN REQUEST%s] [%s%s%s] %s%s%s requested an admin on %s : %s%s',
+        # RECENT ACTIVITY PATTERNS
+        'p5': ' - [B]%s[/B]: %s',
+        'i5': ' - %s%s%s: %s',
+        # DIGEST PATTERNS
+        'p6': '[B][ADMIN REQUESTS DIGEST][/B] [B]%s[/B] : [B]%s[/B] in the last hour, [B]%s[/B] in the last day, '
+              '[B]%s[/B] unanswered, median time to admin arrival: [B]%s[/B]',
+        'i6': '%s[%sADMIN REQUESTS DIGEST%s] %s : %s%s%s in the last hour, %s%s%s in the last day, '
+              '%s%s%s unanswered, median time to admin arrival: %s%s%s',
     }
 
-    settings = {
+    # published settings snapshot (see onLoadConfig)
+    settings = None
+
+    default_settings = {
         'ip': '127.0.0.1',
         'port': 10011,
         'serverid': 1,
         'username': '',
         'password': '',
-        'hostname': '',
+        'hostname_ttl': 300,
         'msg_groupid': -1,
+        'msg_mode': 'global',
+        'msg_channelid': -1,
+        'presence_ttl': 60,
+        'listen': False,
+        'capture': '',
+        'profile_file': '@home/calladmin.prof',
         'treshold': 3600,
-        'useirc': True
+        'useirc': True,
+        'activity_size': 10,
+        'activity_players': 64,
+        'digest_interval': 0,
+        'digest_teamspeak': True,
+        'digest_channelid': -1,
+        'digest_irc': True
     }
 
     ####################################################################################################################
@@ -124,85 +225,388 @@ class CalladminPlugin(b3.plugin.Plugin):
     def onLoadConfig(self):
         """
         Load plugin configuration.
+        Settings are parsed into a new dict which is then published as a whole (see apply_settings):
+        the published dict is never modified afterwards so handlers can read it without locking.
         """
+        settings = dict(self.default_settings)
+
         try:
-            self.settings['treshold'] = self.config.getint('settings', 'treshold')
-            self.debug('loaded settings/treshold: %s' % self.settings['treshold'])
+            settings['treshold'] = self.config.getint('settings', 'treshold')
+            self.debug('loaded settings/treshold: %s' % settings['treshold'])
         except NoOptionError:
-            self.warning('could not find settings/treshold in config file, using default: %s' % self.settings['treshold'])
+            self.warning('could not find settings/treshold in config file, using default: %s' % settings['treshold'])
         except ValueError, e:
             self.error('could not load settings/treshold config value: %s' % e)
-            self.debug('using default value (%s) for settings/treshold' % self.settings['treshold'])
+            self.debug('using default value (%s) for settings/treshold' % settings['treshold'])
 
         try:
-            self.settings['useirc'] = self.config.getboolean('settings', 'useirc')
-            self.debug('loaded settings/useirc: %s' % self.settings['useirc'])
+            settings['useirc'] = self.config.getboolean('settings', 'useirc')
+            self.debug('loaded settings/useirc: %s' % settings['useirc'])
         except NoOptionError:
-            self.warning('could not find settings/useirc in config file, using default: %s' % self.settings['useirc'])
+            self.warning('could not find settings/useirc in config file, using default: %s' % settings['useirc'])
         except ValueError, e:
             self.error('could not load settings/useirc config value: %s' % e)
-            self.debug('using default value (%s) for settings/useirc' % self.settings['useirc'])
+            self.debug('using default value (%s) for settings/useirc' % settings['useirc'])
+
+        try:
+            settings['activity_size'] = self.config.getint('settings', 'activity_size')
+            if settings['activity_size'] < 0:
+                self.warning('settings/activity_size config value is negative: players activity will not be recorded')
+                settings['activity_size'] = 0
+            self.debug('loaded settings/activity_size: %s' % settings['activity_size'])
+        except NoOptionError:
+            self.warning('could not find settings/activity_size in config file, '
+                         'using default: %s' % settings['activity_size'])
+        except ValueError, e:
+            self.error('could not load settings/activity_size config value: %s' % e)
+            self.debug('using default value (%s) for settings/activity_size' % settings['activity_size'])
+
+        try:
+            settings['activity_players'] = self.config.getint('settings', 'activity_players')
+            if settings['activity_players'] < 1:
+                self.warning('settings/activity_players config value is too low: using minimum value (1)')
+                settings['activity_players'] = 1
+            self.debug('loaded settings/activity_players: %s' % settings['activity_players'])
+        except NoOptionError:
+            self.warning('could not find settings/activity_players in config file, '
+                         'using default: %s' % settings['activity_players'])
+        except ValueError, e:
+            self.error('could not load settings/activity_players config value: %s' % e)
+            self.debug('using default value (%s) for settings/activity_players' % settings['activity_players'])
 
         try:
-            self.settings['ip'] = self.config.get('teamspeak', 'ip')
-            self.debug('loaded teamspeak/ip: %s' % self.settings['ip'])
+            settings['ip'] = self.config.get('teamspeak', 'ip')
+            self.debug('loaded teamspeak/ip: %s' % settings['ip'])
         except NoOptionError:
-            self.warning('could not find teamspeak/ip in config file, using default: %s' % self.settings['ip'])
+            self.warning('could not find teamspeak/ip in config file, using default: %s' % settings['ip'])
 
         try:
-            self.settings['port'] = self.config.getint('teamspeak', 'port')
-            self.debug('loaded teamspeak/port: %s' % self.settings['port'])
+            settings['port'] = self.config.getint('teamspeak', 'port')
+            self.debug('loaded teamspeak/port: %s' % settings['port'])
         except NoOptionError:
-            self.warning('could not find teamspeak/port in config file, using default: %s' % self.settings['port'])
+            self.warning('could not find teamspeak/port in config file, using default: %s' % settings['port'])
         except ValueError, e:
             self.error('could not load teamspeak/port config value: %s' % e)
-            self.debug('using default value (%s) for teamspeak/port' % self.settings['port'])
+            self.debug('using default value (%s) for teamspeak/port' % settings['port'])
 
         try:
-            self.settings['serverid'] = self.config.getint('teamspeak', 'serverid')
-            self.debug('loaded teamspeak/serverid: %s' % self.settings['serverid'])
+            settings['serverid'] = self.config.getint('teamspeak', 'serverid')
+            self.debug('loaded teamspeak/serverid: %s' % settings['serverid'])
         except NoOptionError:
             self.warning('could not find teamspeak/serverid in config file, '
-                         'using default: %s' % self.settings['serverid'])
+                         'using default: %s' % settings['serverid'])
         except ValueError, e:
             self.error('could not load teamspeak/serverid config value: %s' % e)
-            self.debug('using default value (%s) for teamspeak/serverid' % self.settings['serverid'])
+            self.debug('using default value (%s) for teamspeak/serverid' % settings['serverid'])
 
         try:
-            self.settings['username'] = self.config.get('teamspeak', 'username')
-            self.debug('loaded teamspeak/username: %s' % self.settings['username'])
+            settings['username'] = self.config.get('teamspeak', 'username')
+            self.debug('loaded teamspeak/username: %s' % settings['username'])
         except NoOptionError:
             self.error('could not find teamspeak/username in config file: plugin will be disabled')
 
         try:
-            self.settings['password'] = self.config.get('teamspeak', 'password')
-            self.debug('loaded teamspeak/password: %s' % self.settings['password'])
+            settings['password'] = self.config.get('teamspeak', 'password')
+            self.debug('loaded teamspeak/password: %s' % settings['password'])
         except NoOptionError:
             self.error('could not find teamspeak/password in config file: plugin will be disabled')
 
-        # default behaviour: global message
-        self.send_teamspeak_message = self._send_global_teamspeak_message
-
         try:
-            self.settings['msg_groupid'] = self.config.getint('teamspeak', 'msg_groupid')
-            if  self.settings['msg_groupid'] == -1:
-                self.send_teamspeak_message = self._send_global_teamspeak_message
+            settings['msg_groupid'] = self.config.getint('teamspeak', 'msg_groupid')
+            if settings['msg_groupid'] == -1:
                 self.debug('setting teamspeak/msg_groupid is set to default value [-1]: admin request will be '
                            'broadcasted to all the people connected to the Teamspeak 3 server (global chat area)')
             else:
-                self.debug('loaded teamspeak/msg_groupid: %s' % self.settings['msg_groupid'])
-                self.send_teamspeak_message = self._send_personal_teamspeak_message
+                self.debug('loaded teamspeak/msg_groupid: %s' % settings['msg_groupid'])
         except NoOptionError:
-            self.send_teamspeak_message = self._send_global_teamspeak_message
             self.warning('could not find teamspeak/msg_groupid in config file: admin request will be '
                          'broadcasted to all the people connected to the Teamspeak 3 server (global chat area)')
         except ValueError:
-            self.send_teamspeak_message = self._send_global_teamspeak_message
+            settings['msg_groupid'] = -1
             self.warning('could not load teamspeak/msg_groupid config value: admin request will be '
                          'broadcasted to all the people connected to the Teamspeak 3 server (global chat area)')
 
-        # get the server hostname
-        self.settings['hostname'] = self.get_hostname()
+        try:
+            settings['msg_channelid'] = self.config.getint('teamspeak', 'msg_channelid')
+            self.debug('loaded teamspeak/msg_channelid: %s' % settings['msg_channelid'])
+        except NoOptionError:
+            self.debug('could not find teamspeak/msg_channelid in config file: channel mode will not be available')
+        except ValueError, e:
+            self.error('could not load teamspeak/msg_channelid config value: %s' % e)
+            self.debug('using default value (%s) for teamspeak/msg_channelid' % settings['msg_channelid'])
+
+        try:
+            settings['msg_mode'] = self.config.get('teamspeak', 'msg_mode').lower()
+            self.debug('loaded teamspeak/msg_mode: %s' % settings['msg_mode'])
+        except NoOptionError:
+            # backwards compatibility: the mode used to be implied by the group id
+            settings['msg_mode'] = 'global' if settings['msg_groupid'] == -1 else 'group'
+            self.debug('could not find teamspeak/msg_mode in config file, using: %s' % settings['msg_mode'])
+
+        settings['msg_mode'] = self.check_message_mode('teamspeak', settings)
+
+        try:
+            settings['presence_ttl'] = self.config.getint('teamspeak', 'presence_ttl')
+            if settings['presence_ttl'] < 10:
+                self.warning('teamspeak/presence_ttl config value is too low: using minimum value (10)')
+                settings['presence_ttl'] = 10
+            self.debug('loaded teamspeak/presence_ttl: %s' % settings['presence_ttl'])
+        except NoOptionError:
+            self.warning('could not find teamspeak/presence_ttl in config file, '
+                         'using default: %s' % settings['presence_ttl'])
+        except ValueError, e:
+            self.error('could not load teamspeak/presence_ttl config value: %s' % e)
+            self.debug('using default value (%s) for teamspeak/presence_ttl' % settings['presence_ttl'])
+
+        try:
+            settings['capture'] = self.config.get('teamspeak', 'capture')
+            if settings['capture']:
+                settings['capture'] = b3.getWritableFilePath(settings['capture'])
+                self.warning('server query traffic will be recorded in %s: disable it when you are done' %
+                             settings['capture'])
+            self.debug('loaded teamspeak/capture: %s' % settings['capture'])
+        except NoOptionError:
+            self.debug('could not find teamspeak/capture in config file: server query traffic will not be recorded')
+
+        try:
+            settings['listen'] = self.config.getboolean('teamspeak', 'listen')
+            self.debug('loaded teamspeak/listen: %s' % settings['listen'])
+        except NoOptionError:
+            self.debug('could not find teamspeak/listen in config file, using default: %s' % settings['listen'])
+        except ValueError, e:
+            self.error('could not load teamspeak/listen config value: %s' % e)
+            self.debug('using default value (%s) for teamspeak/listen' % settings['listen'])
+
+        if settings['listen'] and settings['msg_groupid'] == -1:
+            # replies are accepted only from the members of the staff server group
+            self.warning('teamspeak/listen requires a valid teamspeak/msg_groupid: Teamspeak 3 replies will be ignored')
+            settings['listen'] = False
+
+        # additional Teamspeak 3 servers are defined in [teamspeak:<name>] sections
+        settings['targets'] = [dict([(x, settings[x]) for x in TeamspeakTarget.keys], name='teamspeak')]
+        for section in self.config.sections():
+            if section.startswith('teamspeak:'):
+                target = self.load_target_settings(section, settings['targets'][0])
+                if target is not None:
+                    settings['targets'].append(target)
+
+        try:
+            settings['profile_file'] = self.config.get('settings', 'profile_file')
+            self.debug('loaded settings/profile_file: %s' % settings['profile_file'])
+        except NoOptionError:
+            self.warning('could not find settings/profile_file in config file, '
+                         'using default: %s' % settings['profile_file'])
+
+        try:
+            settings['hostname_ttl'] = self.config.getint('settings', 'hostname_ttl')
+            self.debug('loaded settings/hostname_ttl: %s' % settings['hostname_ttl'])
+        except NoOptionError:
+            self.warning('could not find settings/hostname_ttl in config file, '
+                         'using default: %s' % settings['hostname_ttl'])
+        except ValueError, e:
+            self.error('could not load settings/hostname_ttl config value: %s' % e)
+            self.debug('using default value (%s) for settings/hostname_ttl' % settings['hostname_ttl'])
+
+        if 'digest' in self.config.sections():
+            self.load_digest_settings(settings)
+
+        # reason categories are defined in [category:<name>] sections
+        settings['categories'] = []
+        for section in self.config.sections():
+            if section.startswith('category:'):
+                category = self.load_category_settings(section, settings)
+                if category is not None:
+                    settings['categories'].append(category)
+        settings['classifier'] = ReasonClassifier(settings['categories'])
+
+        self.apply_settings(settings)
+
+    def load_digest_settings(self, settings):
+        """
+        Load the periodic digest settings from the [digest] section.
+        :param settings: The settings dict being loaded
+        """
+        for option, getter in (('interval', self.config.getint), ('teamspeak', self.config.getboolean),
+                               ('channelid', self.config.getint), ('irc', self.config.getboolean)):
+            key = 'digest_%s' % option
+            try:
+                settings[key] = getter('digest', option)
+                self.debug('loaded digest/%s: %s' % (option, settings[key]))
+            except NoOptionError:
+                self.debug('could not find digest/%s in config file, using default: %s' % (option, settings[key]))
+            except ValueError, e:
+                self.error('could not load digest/%s config value: %s' % (option, e))
+                self.debug('using default value (%s) for digest/%s' % (settings[key], option))
+
+        if settings['digest_interval'] < 0:
+            self.warning('digest/interval config value is negative: digest will be disabled')
+            settings['digest_interval'] = 0
+
+    def load_target_settings(self, section, defaults):
+        """
+        Load the settings of an additional Teamspeak 3 target: missing options are inherited from [teamspeak].
+        :param section: The configuration section of the target
+        :param defaults: The settings of the main Teamspeak 3 target
+        """
+        target = dict(defaults, name=section)
+        for option in ('ip', 'username', 'password', 'msg_mode'):
+            if self.config.has_option(section, option):
+                target[option] = self.config.get(section, option)
+
+        for option in ('port', 'serverid', 'msg_groupid', 'msg_channelid'):
+            if self.config.has_option(section, option):
+                try:
+                    target[option] = self.config.getint(section, option)
+                except ValueError, e:
+                    self.error('could not load %s/%s config value: %s' % (section, option, e))
+                    self.error('Teamspeak 3 target %s will not receive admin requests' % section)
+                    return None
+
+        if self.config.has_option(section, 'msg_mode'):
+            target['msg_mode'] = target['msg_mode'].lower()
+        elif self.config.has_option(section, 'msg_groupid'):
+            target['msg_mode'] = 'global' if target['msg_groupid'] == -1 else 'group'
+
+        target['msg_mode'] = self.check_message_mode(section, target)
+        self.debug('loaded Teamspeak 3 target %s: %s:%s (virtual server %s, mode %s)' % (section, target['ip'],
+                   target['port'], target['serverid'], target['msg_mode']))
+        return target
+
+    def check_message_mode(self, section, settings):
+        """
+        Validate the delivery mode of a Teamspeak 3 target: fall back on global mode if unusable.
+        :param section: The configuration section the settings belong to
+        :param settings: The target settings dict
+        """
+        error = self.get_message_mode_error(settings)
+        if error is not None:
+            self.warning('%s: %s: admin request will be broadcasted to all the people connected to the '
+                         'Teamspeak 3 server (global chat area)' % (section, error))
+            return 'global'
+        return settings['msg_mode']
+
+    @staticmethod
+    def get_message_mode_error(settings):
+        """
+        Return the reason why the delivery mode of the given settings can't be used (None if valid).
+        """
+        mode = settings['msg_mode']
+        if mode not in TeamspeakTarget.modes:
+            return 'invalid msg_mode config value (%s)' % mode
+        if mode in ('group', 'poke') and settings['msg_groupid'] == -1:
+            return 'msg_mode %s requires a valid msg_groupid' % mode
+        if mode == 'channel' and settings['msg_channelid'] == -1:
+            return 'msg_mode channel requires a valid msg_channelid'
+        return None
+
+    def load_category_settings(self, section, settings):
+        """
+        Load a reason category: admin requests whose reason matches one of the category keywords
+        (or its regular expression) are routed according to the category settings.
+        :param section: The configuration section of the category
+        :param settings: The settings dict being loaded
+        """
+        category = {'name': section.split(':', 1)[1].strip(), 'patterns': [], 'priority': 0,
+                    'treshold': settings['treshold'], 'route': {}}
+
+        if self.config.has_option(section, 'keywords'):
+            keywords = [x.strip() for x in self.config.get(section, 'keywords').split(',') if x.strip()]
+            category['patterns'].extend([r'(?<!\w)%s(?!\w)' % re.escape(x) for x in keywords])
+
+        if self.config.has_option(section, 'regex'):
+            pattern = self.config.get(section, 'regex')
+            try:
+                if re.compile(pattern).groupindex:
+                    raise re.error('named groups are not allowed')
+                category['patterns'].append(pattern)
+            except re.error, e:
+                self.error('could not load %s/regex config value: %s' % (section, e))
+
+        if not category['patterns']:
+            self.error('could not find %s/keywords nor %s/regex in config file: category will be ignored' % (
+                       section, section))
+            return None
+
+        for option in ('priority', 'treshold', 'msg_groupid', 'msg_channelid'):
+            if self.config.has_option(section, option):
+                try:
+                    value = self.config.getint(section, option)
+                except ValueError, e:
+                    self.error('could not load %s/%s config value: %s' % (section, option, e))
+                    continue
+                if option in ('priority', 'treshold'):
+                    category[option] = value
+                else:
+                    category['route'][option] = value
+
+        route = category['route']
+        if self.config.has_option(section, 'msg_mode'):
+            route['msg_mode'] = self.config.get(section, 'msg_mode').lower()
+        elif 'msg_channelid' in route:
+            route['msg_mode'] = 'channel'
+        elif 'msg_groupid' in route:
+            route['msg_mode'] = 'global' if route['msg_groupid'] == -1 else 'group'
+
+        if route:
+            error = self.get_message_mode_error(dict(settings, **route))
+            if error is not None:
+                self.error('%s: %s: admin requests will be delivered as uncategorized ones' % (section, error))
+                category['route'] = {}
+
+        self.debug('loaded reason category %s: %s pattern(s), priority %s, treshold %s, routing %s' % (
+                   category['name'], len(category['patterns']), category['priority'], category['treshold'],
+                   category['route'] or 'default'))
+        return category
+
+    def apply_settings(self, settings):
+        """
+        Publish a new settings snapshot: Teamspeak 3 sessions and message strategies are
+        rebuilt only if the settings they depend on changed (pending requests are kept).
+        :param settings: The settings dict to be published
+        """
+        previous = self.settings or {}
+
+        def changed(*keys):
+            return any(previous.get(key) != settings[key] for key in keys)
+
+        if changed('capture'):
+            self.capture = ServerQueryCapture(settings['capture']) if settings['capture'] else None
+
+        targets = []
+        current = dict([(x.name, x) for x in self.targets])
+        for target_settings in settings['targets']:
+            target = current.pop(target_settings['name'], None)
+            if target is None or changed('capture') or not target.same_connection(target_settings):
+                if target is not None:
+                    self.debug('Teamspeak 3 target %s server query settings changed: session rebuilt' % target.name)
+                    target.close()
+                target = TeamspeakTarget(target_settings, self.capture)
+            else:
+                # swaps the message strategy only if the group changed
+                target.configure(target_settings)
+            targets.append(target)
+
+        for target in current.values():
+            self.debug('Teamspeak 3 target %s removed' % target.name)
+            target.close()
+
+        self.targets = targets
+
+        if self.replyEvent is not None and changed('listen', 'capture', 'msg_mode', 'msg_channelid',
+                                                   *TeamspeakTarget.connection):
+            self.start_listener(settings)
+
+        if self.stats is None:
+            self.stats = RequestStats()
+
+        if self.categoryRequests is None:
+            self.categoryRequests = {}
+
+        if changed('activity_size', 'activity_players'):
+            # recorded activity is dropped: buffers are sized at creation
+            self.activity = PlayerActivity(settings['activity_size'], settings['activity_players'])
+
+        self.settings = settings
 
     def onStartup(self):
         """
@@ -227,14 +631,51 @@ class CalladminPlugin(b3.plugin.Plugin):
                 if func:
                     self.adminPlugin.registerCommand(self, cmd, level, func, alias)
 
+        # replies written by the staff on Teamspeak 3 are handed to the event thread through our own event
+        self.replyEvent = self.console.createEvent('EVT_CALLADMIN_REPLY', 'Calladmin Teamspeak 3 reply')
+
         try:
             # B3 > 1.10dev
             self.registerEvent(self.console.getEventID('EVT_CLIENT_AUTH'), self.onAuth)
             self.registerEvent(self.console.getEventID('EVT_CLIENT_DISCONNECT'), self.onDisconnect)
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_SAY'), self.onSay)
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_TEAM_SAY'), self.onSay)
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_KILL'), self.onKill)
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_KILL_TEAM'), self.onKill)
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_TEAM_CHANGE'), self.onTeamChange)
+            self.registerEvent(self.replyEvent, self.onReply)
         except TypeError:
             # B3 < 1.10dev
             self.registerEvent(self.console.getEventID('EVT_CLIENT_AUTH'))
             self.registerEvent(self.console.getEventID('EVT_CLIENT_DISCONNECT'))
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_SAY'))
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_TEAM_SAY'))
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_KILL'))
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_KILL_TEAM'))
+            self.registerEvent(self.console.getEventID('EVT_CLIENT_TEAM_CHANGE'))
+            self.registerEvent(self.replyEvent)
+
+        # refresh the staff presence in the background so that commands never wait for the server query
+        if self.presenceCrontab:
+            self.console.cron - self.presenceCrontab
+        self.presenceCrontab = b3.cron.PluginCronTab(self, self.update_staff_presence, second='*/10')
+        self.console.cron + self.presenceCrontab
+
+        # the server hostname is retrieved on first use or by the cron, never during startup
+        if self.hostnameCrontab:
+            self.console.cron - self.hostnameCrontab
+        self.hostnameCrontab = b3.cron.PluginCronTab(self, self.update_hostname, second='*/10')
+        self.console.cron + self.hostnameCrontab
+
+        # the digest crontab runs every minute: it posts only when the configured interval is elapsed
+        if self.digestCrontab:
+            self.console.cron - self.digestCrontab
+        self.lastDigest = self.console.time()
+        self.digestCrontab = b3.cron.PluginCronTab(self, self.update_digest, second=0)
+        self.console.cron + self.digestCrontab
+
+        # listen for replies written by the staff on Teamspeak 3 (if enabled)
+        self.start_listener(self.settings)
 
         # notice plugin startup
         self.debug('plugin started')
@@ -254,22 +695,50 @@ class CalladminPlugin(b3.plugin.Plugin):
             self.onAuth(event)
         elif event.type == self.console.getEventID('EVT_CLIENT_DISCONNECT'):
             self.onDisconnect(event)
+        elif event.type in (self.console.getEventID('EVT_CLIENT_SAY'), self.console.getEventID('EVT_CLIENT_TEAM_SAY')):
+            self.onSay(event)
+        elif event.type in (self.console.getEventID('EVT_CLIENT_KILL'), self.console.getEventID('EVT_CLIENT_KILL_TEAM')):
+            self.onKill(event)
+        elif event.type == self.console.getEventID('EVT_CLIENT_TEAM_CHANGE'):
+            self.onTeamChange(event)
+        elif event.type == self.replyEvent:
+            self.onReply(event)
+
+    def onEnable(self):
+        """
+        Executed when the plugin is enabled.
+        """
+        if self.replyEvent is not None:
+            self.start_listener(self.settings)
+
+    def onDisable(self):
+        """
+        Executed when the plugin is disabled.
+        """
+        self.stop_listener()
 
     def onAuth(self, event):
         """
         Executed when EVT_CLIENT_AUTH is intercepted.
         """
         client = event.client
-        if self.adminRequest is not None:
+        if self.ackRequest is not None and self.adminRequest is None:
+            if client.maxLevel >= self.adminPlugin._admins_level:
+                # the admin who acknowledged the request (or another one) showed up
+                self.debug('admin connected to the server: %s [%s]' % (client.name, client.maxLevel))
+                self.stats.arrival(int(time.time()) - self.ackRequest['time'])
+                self.ackRequest = None
+        elif self.adminRequest is not None:
             if client.maxLevel >= self.adminPlugin._admins_level:
                 # send a message on teamspeak informing that someone connected to handle the request
                 self.debug('admin connected to the server: %s [%s]' % (client.name, client.maxLevel))
-                hostname = self.console.stripColors(self.settings['hostname'])
-                message = self.patterns['p1'] % (client.name, client.maxLevel, hostname)
+                now = int(time.time())
+                self.stats.arrival(now - self.adminRequest['time'])
+                hostname = self.get_hostnames()
+                message = self.patterns['p1'] % (client.name, client.maxLevel, hostname['ts3'])
                 self.send_teamspeak_message(message)
                 if self.settings['useirc'] and self.ircbotPlugin:
-                    hostname = convert_colors(self.settings['hostname'])
-                    message = self.patterns['i1'] % (RESET, MAGENTA, RESET, ORANGE, client.name, RESET, GREEN, client.maxLevel, RESET, hostname)
+                    message = self.patterns['i1'] % (RESET, MAGENTA, RESET, ORANGE, client.name, RESET, GREEN, client.maxLevel, RESET, hostname['irc'])
                     self.send_irc_message(convert_colors(message))
                 self.adminRequest['client'].message('^7[^2ADMIN ONLINE^7] %s [^3%s^7]' % (client.name, client.maxLevel))
                 self.adminRequest = None
@@ -279,18 +748,73 @@ class CalladminPlugin(b3.plugin.Plugin):
         Executed when EVT_CLIENT_DISCONNECT is intercepted.
         """
         client = event.client
+        if self.ackRequest is not None and self.ackRequest['client'] == client:
+            self.debug('acknowledged admin request canceled: %s disconnected from the server' % client.name)
+            self.stats.unanswered(int(time.time()))
+            self.ackRequest = None
         if self.adminRequest is not None:
             if self.adminRequest['client'] == client:
                 self.debug('admin request canceled: %s disconnected from the server' % client.name)
-                hostname = self.console.stripColors(self.settings['hostname'])
-                message = self.patterns['p2'] % (client.name, hostname)
+                self.stats.unanswered(int(time.time()))
+                hostname = self.get_hostnames()
+                message = self.patterns['p2'] % (client.name, hostname['ts3'])
                 self.send_teamspeak_message(message)
                 if self.settings['useirc'] and self.ircbotPlugin:
-                    hostname = convert_colors(self.settings['hostname'])
-                    message = self.patterns['i2'] % (RESET, MAGENTA, RESET, ORANGE, client.name, RESET, hostname)
+                    message = self.patterns['i2'] % (RESET, MAGENTA, RESET, ORANGE, client.name, RESET, hostname['irc'])
                     self.send_irc_message(message)
                 self.adminRequest = None
 
+    def onReply(self, event):
+        """
+        Executed when EVT_CALLADMIN_REPLY is intercepted (a staff member replied on Teamspeak 3).
+        """
+        reply = event.data
+        if self.adminRequest is None:
+            self.debug('ignoring !%s from %s: there is no pending admin request' % (reply['command'], reply['name']))
+            return
+
+        client = self.adminRequest['client']
+        if reply['command'] == 'ack':
+            self.debug('admin request acknowledged on Teamspeak 3 by %s' % reply['name'])
+            client.message('^7[^2ACK^7] ^3%s ^7is on the way%s' % (reply['name'], ': %s' % reply['text'] if reply['text'] else ''))
+            # keep the request start time: the arrival is recorded when the admin shows up
+            self.ackRequest = self.adminRequest
+        else:
+            self.debug('admin request dismissed on Teamspeak 3 by %s' % reply['name'])
+            client.message('^7[^1DISMISSED^7] ^3%s^7: %s' % (reply['name'], reply['text'] or 'request dismissed'))
+            self.stats.unanswered(int(time.time()))
+        # the request is no longer pending but still counts for the treshold
+        self.resolvedRequest = self.adminRequest
+        self.adminRequest = None
+
+    def onSay(self, event):
+        """
+        Executed when EVT_CLIENT_SAY or EVT_CLIENT_TEAM_SAY is intercepted.
+        """
+        text = event.data and event.data.strip()
+        if not text or text[:1] in self.get_command_prefixes():
+            # commands are not part of the player activity
+            return
+        kind = 'team say' if event.type == self.console.getEventID('EVT_CLIENT_TEAM_SAY') else 'say'
+        self.activity.add(event.client, self.console.time(), kind, self.console.stripColors(text))
+
+    def onKill(self, event):
+        """
+        Executed when EVT_CLIENT_KILL or EVT_CLIENT_KILL_TEAM is intercepted.
+        """
+        if event.client is None or event.target is None:
+            return
+        kind = 'team kill' if event.type == self.console.getEventID('EVT_CLIENT_KILL_TEAM') else 'kill'
+        now = self.console.time()
+        self.activity.add(event.client, now, kind, event.target.name)
+        self.activity.add(event.target, now, 'killed by', event.client.name)
+
+    def onTeamChange(self, event):
+        """
+        Executed when EVT_CLIENT_TEAM_CHANGE is intercepted.
+        """
+        self.activity.add(event.client, self.console.time(), 'team', self.teams.get(event.data, 'unknown'))
+
     ####################################################################################################################
     #                                                                                                                  #
     #   OTHER METHODS                                                                                                  #
@@ -310,6 +834,126 @@ class CalladminPlugin(b3.plugin.Plugin):
         s = round(s/3600)
         return '%d hour%s' % (s, 's' if s != 1 else '')
 
+    def update_digest(self):
+        """
+        Post the admin requests digest if the configured interval is elapsed.
+        Executed by the cron thread every minute.
+        """
+        settings = self.settings
+        if not settings['digest_interval']:
+            return
+        now = self.console.time()
+        if now - self.lastDigest < settings['digest_interval'] * 60 - 1:
+            return
+        self.lastDigest = now
+        self.post_digest()
+
+    def post_digest(self):
+        """
+        Post the admin requests digest on Teamspeak 3 and/or IRC.
+        """
+        settings = self.settings
+        summary = self.stats.summary(int(time.time()))
+        median = self.get_timestring(summary['median']) if summary['median'] is not None else 'n/a'
+        hostname = self.get_hostnames()
+        self.debug('posting admin requests digest: %s' % summary)
+        if settings['digest_teamspeak']:
+            message = self.patterns['p6'] % (hostname['ts3'], summary['hour'], summary['day'], summary['unanswered'], median)
+            if settings['digest_channelid'] != -1:
+                self.send_teamspeak_message(message, {'msg_mode': 'channel', 'msg_channelid': settings['digest_channelid']})
+            else:
+                self.send_teamspeak_message(message)
+        if settings['digest_irc'] and settings['useirc'] and self.ircbotPlugin:
+            message = self.patterns['i6'] % (RESET, MAGENTA, RESET, hostname['irc'], ORANGE, summary['hour'], RESET,
+                                             ORANGE, summary['day'], RESET, ORANGE, summary['unanswered'], RESET,
+                                             ORANGE, median, RESET)
+            self.send_irc_message(convert_colors(message))
+
+    def start_listener(self, settings):
+        """
+        (Re)start the Teamspeak 3 text messages listener (if enabled).
+        """
+        self.stop_listener()
+        if settings['listen']:
+            self.debug('starting Teamspeak 3 listener: staff can reply !ack or !dismiss to admin requests')
+            self.listener = TeamspeakListener(self, settings, self.capture)
+            self.listener.start()
+
+    def stop_listener(self):
+        """
+        Stop the Teamspeak 3 text messages listener.
+        """
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+
+    def on_teamspeak_text(self, data):
+        """
+        Executed by the listener thread when a text message is written on Teamspeak 3:
+        replies to admin requests are queued as EVT_CALLADMIN_REPLY.
+        :param data: The parsed notifytextmessage
+        """
+        parts = unicode(data.get('msg', '')).strip().split(' ', 1)
+        command = parts[0].lower()
+        if command not in ('!ack', '!dismiss'):
+            return
+        name = unicode(data.get('invokername', 'unknown'))
+        if not self.is_teamspeak_staff(data.get('invokerid')):
+            self.debug('ignoring %s from %s: not a member of the Teamspeak 3 staff group' % (command, name))
+            return
+        reply = {'command': command[1:], 'name': name,
+                 'text': parts[1].strip() if len(parts) > 1 else ''}
+        self.console.queueEvent(b3.events.Event(self.replyEvent, reply))
+
+    def is_teamspeak_staff(self, clid):
+        """
+        Tell whether the given Teamspeak 3 client belongs to the server group receiving admin requests
+        on the primary target (server query clients never do). Executed by the listener thread.
+        :param clid: The Teamspeak 3 client id
+        """
+        target = self.targets[0] if self.targets else None
+        if target is None or clid is None or target.settings['msg_groupid'] == -1:
+            return False
+        try:
+            clients = self.get_teamspeak_clients(target.session, target.settings['msg_groupid'])
+        except (TS3Error, EOFError, telnetlib.socket.error), e:
+            self.warning('could not check Teamspeak 3 client %s server groups: %s' % (clid, e))
+            return False
+        return clid in [x['clid'] for x in clients]
+
+    def get_command_prefixes(self):
+        """
+        Return the command prefixes used by the admin plugin.
+        """
+        prefixes = (self.adminPlugin.cmdPrefix, self.adminPlugin.cmdPrefixLoud,
+                    self.adminPlugin.cmdPrefixBig, getattr(self.adminPlugin, 'cmdPrefixPrivate', None))
+        return [x for x in prefixes if x]
+
+    def get_activity_summaries(self, client, reason):
+        """
+        Return a list of (name, summary) tuples describing the recent activity of the reporter
+        and of the players named in the reason (players without recorded activity are skipped).
+        At most activity_named players named in the reason are considered.
+        :param client: The client who requested an admin
+        :param reason: The reason of the admin request
+        """
+        players = [client]
+        lower = reason.lower()
+        for c in self.console.clients.getList():
+            name = self.console.stripColors(c.name).lower()
+            if c != client and len(name) > 2 and name in lower:
+                players.append(c)
+                if len(players) > self.activity_named:
+                    break
+
+        summaries = []
+        now = self.console.time()
+        for c in players:
+            records = self.activity.get(c, self.activity_summary)
+            if records:
+                summaries.append((c.name, ', '.join([x.describe(now) for x in records])))
+        return summaries
+
     def get_hostname(self):
         """
         Return the server hostname.
@@ -324,64 +968,200 @@ class CalladminPlugin(b3.plugin.Plugin):
             self.warning('could not retrieve server var (%s) : %s' % (name, e))
             return '%s:%s' % (self.console._rconIp, self.console._rconPort)
 
-    def _send_global_teamspeak_message(self, message):
+    @staticmethod
+    def get_teamspeak_clients(sq, groupid=-1):
         """
-        Send a global message over the Teamspeak 3 server.
+        Return the list of clients connected to the Teamspeak 3 server (server query clients excluded).
+        :param sq: The ServerQuery (or TeamspeakSession) to be used
+        :param groupid: If different from -1, return only the clients belonging to this server group
+        """
+        clients = []
+        for clientdict in sq.command('clientlist', option=['groups']):
+            if clientdict.get('client_type') != 0:
+                continue
+            if groupid != -1:
+                client_servergroups = [int(x) for x in str(clientdict.get('client_servergroups', '')).split(',') if x]
+                if groupid not in client_servergroups:
+                    continue
+            clients.append(clientdict)
+        return clients
+
+    def update_staff_presence(self):
+        """
+        Refresh the cached list of staff members connected to the Teamspeak 3 servers.
+        Executed by the cron thread: a cache is refreshed when half of its lifetime is elapsed.
+        """
+        ttl = self.settings['presence_ttl']
+        for target in self.targets:
+            settings = target.settings
+            presence = target.presence
+            if presence is not None and self.console.time() - presence['time'] < ttl / 2:
+                continue
+
+            try:
+                clients = target.get_clients()
+            except (TS3Error, EOFError, telnetlib.socket.error), e:
+                self.warning('could not refresh Teamspeak 3 staff presence on %s: %s' % (target.name, e))
+                continue
+
+            if settings is not target.settings:
+                # configuration reloaded in the meantime: the result may refer to another group
+                continue
+
+            self.verbose('refreshed Teamspeak 3 staff presence on %s: %s client(s) online' % (target.name, len(clients)))
+            target.set_presence(clients, self.console.time())
+
+    def get_staff_presence(self):
+        """
+        Return the cached list of staff members connected to the Teamspeak 3 servers.
+        Will return None if no cached value is available (missing or expired).
+        """
+        now = self.console.time()
+        clients = None
+        for target in self.targets:
+            presence = target.presence
+            if presence is not None and now - presence['time'] <= self.settings['presence_ttl']:
+                clients = (clients or []) + presence['clients']
+        return clients
+
+    def update_hostname(self):
+        """
+        Refresh the cached server hostname: a new hostname reported by the parser is picked up
+        immediately, otherwise the game server is queried once settings/hostname_ttl is elapsed.
+        Executed by the cron thread (and by get_hostnames() on first use).
+        """
+        cached = self.hostname
+        current = getattr(self.console.game, 'sv_hostname', None)
+        if current and current != self.gameHostname:
+            # compare with what the parser reported last time, not with the cached value, which
+            # may come from the game server: a stale parser value must not undo a refresh
+            self.gameHostname = current
+            self.set_hostname(current)
+        elif cached is None or self.console.time() - cached['time'] >= self.settings['hostname_ttl']:
+            self.set_hostname(self.get_hostname())
+
+    def set_hostname(self, hostname):
+        """
+        Store the server hostname along with its Teamspeak 3 and IRC formatted variants.
+        """
+        if self.hostname is None or self.hostname['raw'] != hostname:
+            self.debug('server hostname: %s' % hostname)
+        self.hostname = {'time': self.console.time(), 'raw': hostname,
+                         'ts3': self.console.stripColors(hostname), 'irc': convert_colors(hostname)}
+
+    def get_hostnames(self):
+        """
+        Return the cached server hostname variants as a dict with 'raw', 'ts3' and 'irc' keys.
+        """
+        if self.hostname is None:
+            self.update_hostname()
+        return self.hostname
+
+    def send_teamspeak_message(self, message, route=None):
+        """
+        Send a message over all the Teamspeak 3 targets: when more than one target is
+        configured they are notified in parallel, so the slowest one bounds the delivery time.
+        Will return True if at least one target received the message.
         :param message: The message to be sent
+        :param route: An optional dict overriding msg_mode, msg_groupid and msg_channelid of every target
+        """
+        targets = self.targets
+        results = {}
+        if len(targets) == 1:
+            self._send_target_message(targets[0], message, route, results)
+        else:
+            threads = []
+            for target in targets:
+                t = threading.Thread(target=self._send_target_message, args=(target, message, route, results),
+                                     name='calladmin-%s' % target.name)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join(self.delivery_timeout)
+            self.debug('admin request delivered to %s/%s Teamspeak 3 targets: %s' % (
+                       results.values().count(True), len(targets),
+                       ', '.join(['%s=%s' % (x.name, 'ok' if results.get(x.name) else 'failed') for x in targets])))
+
+        return any(results.values())
+
+    def _send_target_message(self, target, message, route, results):
+        """
+        Send a message over a Teamspeak 3 target storing the outcome in the results dict.
         """
         try:
-
+            send, settings = target.get_route(route)
             # print in the log what we are going to send
-            self.debug('broadcasting admin request: %s' % message)
-
-            # establish a connection object with the teamspeak server query
-            sq = ServerQuery(self.settings['ip'], self.settings['port'])
-            sq.connect()
-            sq.command('login', {'client_login_name': self.settings['username'], 'client_login_password': self.settings['password']})
-            sq.command('use', {'sid': self.settings['serverid']})
-            sq.command('sendtextmessage', {'targetmode': 3, 'target': 1, 'msg': message})
-
-            return True
-
-        except (TS3Error, telnetlib.socket.error), e:
-            self.error('could not broadcast message over the teamspeak 3 server query interface: %s' % e)
-            if e.code == 3329:
+            mode = settings['msg_mode']
+            if mode == 'global':
+                self.debug('broadcasting admin request on %s: %s' % (target.name, message))
+            elif mode == 'channel':
+                self.debug('sending admin request to channel [%s] on %s: %s' % (
+                           settings['msg_channelid'], target.name, message))
+            else:
+                self.debug('sending admin request (%s) to all the people in group [%s] on %s: %s' % (
+                           mode, settings['msg_groupid'], target.name, message))
+            send(message, settings)
+            results[target.name] = True
+        except (TS3Error, EOFError, telnetlib.socket.error), e:
+            self.error('could not send message over the teamspeak 3 server query interface of %s: %s' % (target.name, e))
+            if getattr(e, 'code', None) == 3329:
                 self.warning('B3 is banned from the Teamspeak 3 server: make sure you add the b3 '
                              'ip to your Teamspeak 3 server white list (query_ip_whitelist.txt)')
-            return False
+            results[target.name] = False
 
-    def _send_personal_teamspeak_message(self, message):
+    def get_profiled_callables(self):
         """
-        Send a message over the Teamspeak 3 server to all the people belonging
-        to the Teamspeak 3 group matching the 'msg_groupid' configuration value.
+        Return a list of (getter, setter) tuples, one for every entry point of the plugin
+        code (event hooks, commands and crontabs): these are the callables being profiled.
         """
-        try:
+        def attribute(obj, name):
+            return lambda: getattr(obj, name), lambda value: setattr(obj, name, value)
 
-            # print in the log what we are going to send
-            self.debug('sending admin request to all the people in group [%s]: %s' % (self.settings['msg_groupid'], message))
-
-            # establish a connection object with the teamspeak server query
-            sq = ServerQuery(self.settings['ip'], self.settings['port'])
-            sq.connect()
-            sq.command('login', {'client_login_name': self.settings['username'], 'client_login_password': self.settings['password']})
-            sq.command('use', {'sid': self.settings['serverid']})
-
-            clientlist = sq.command('clientlist')
-            for clientdict in clientlist:
-                clientinfo = sq.command('clientinfo', {'clid': clientdict['clid']})
-                if 'client_servergroups' in clientinfo:
-                    client_servergroups = [int(x) for x in str(clientinfo['client_servergroups']).split(',')]
-                    if self.settings['msg_groupid'] in client_servergroups:
-                        sq.command('sendtextmessage', {'targetmode': 1, 'target': clientdict['clid'], 'msg': message})
+        def item(collection, index):
+            return lambda: collection[index], lambda value: collection.__setitem__(index, value)
 
-            return True
+        entries = []
+        for hooks in self.eventmap.values():
+            for index in range(len(hooks)):
+                entries.append(item(hooks, index))
 
-        except (TS3Error, telnetlib.socket.error), e:
-            self.error('could send personal message over the teamspeak 3 server query interface: %s' % e)
-            if e.code == 3329:
-                self.warning('B3 is banned from the Teamspeak 3 server: make sure you add the b3 '
-                             'ip to your Teamspeak 3 server white list (query_ip_whitelist.txt)')
-            return False
+        commands = {}
+        for command in self.adminPlugin._commands.values():
+            if command.plugin == self:
+                # aliases share the same command object
+                commands[id(command)] = command
+        for command in commands.values():
+            entries.append(attribute(command, 'func'))
+
+        for crontab in (self.presenceCrontab, self.hostnameCrontab, self.digestCrontab):
+            if crontab:
+                entries.append(attribute(crontab, 'command'))
+
+        return entries
+
+    def start_profiler(self):
+        """
+        Start profiling the plugin entry points: this installs wrappers around them so that
+        the plugin runs its plain code (with no overhead at all) while the profiler is off.
+        Data collected by a previous run is discarded.
+        """
+        self.profiler = CalladminProfiler()
+        self.profiler.running = True
+        for getter, setter in self.get_profiled_callables():
+            if not hasattr(getter(), 'profiled'):
+                setter(self.profiler.wrap(getter()))
+        self.debug('profiler started')
+
+    def stop_profiler(self):
+        """
+        Stop profiling the plugin entry points: collected data is kept until the next start.
+        """
+        for getter, setter in self.get_profiled_callables():
+            if hasattr(getter(), 'profiled'):
+                setter(getter().profiled)
+        self.profiler.running = False
+        self.debug('profiler stopped')
 
     def send_irc_message(self, message):
         """
@@ -420,129 +1200,1034 @@ class CalladminPlugin(b3.plugin.Plugin):
             cmd.sayLoudOrPM(client, '^7Admin%s already online: %s' % ('s' if len(_list) != 1 else '', ', '.join(_list)))
             return
 
-        # checking if someone already submitted a request
-        if self.adminRequest is not None:
-            # if the previous admin request was done less than
-            # self.settings['treshold'] seconds ago, block here
-            when = int(time.time()) - self.adminRequest['time']
-            if when < self.settings['treshold']:
+        # use the same settings snapshot for the whole command (it may be replaced by a reload)
+        settings = self.settings
+
+        # classify the request (a single pass over the reason)
+        reason = self.console.stripColors(data)
+        category = settings['classifier'].classify(reason)
+        priority = category['priority'] if category else 0
+
+        # checking if a request of the same category was sent less than its treshold seconds ago
+        if category is not None and category['name'] in self.categoryRequests:
+            when = int(time.time()) - self.categoryRequests[category['name']]
+            if when < category['treshold']:
+                cmd.sayLoudOrPM(client, '^7Admin request ^1aborted^7: already sent ^3%s ^7ago' % self.get_timestring(when))
+                return
+
+        # checking if someone already submitted a request (even if already resolved on Teamspeak 3)
+        request = self.adminRequest or self.resolvedRequest
+        if request is not None:
+            # if the previous admin request was done less than its own treshold seconds ago block
+            # here, unless the new request belongs to a category with a higher priority
+            when = int(time.time()) - request['time']
+            active = request.get('category')
+            treshold = active['treshold'] if active else settings['treshold']
+            if when < treshold and priority <= (active['priority'] if active else 0):
                 cmd.sayLoudOrPM(client, '^7Admin request ^1aborted^7: already sent ^3%s ^7ago' % self.get_timestring(when))
                 return
 
         # check that we sent at least one admin request
         sent = { 'ts3': False, 'irc': False }
 
-        # send the admin request
-        reason = self.console.stripColors(data)
-        hostname = self.console.stripColors(self.settings['hostname'])
-        message = self.patterns['p3'] % (client.name, hostname, reason)
-        sent['ts3'] = self.send_teamspeak_message(message)
-        if self.settings['useirc'] and self.ircbotPlugin:
+        # send the admin request (along with what the involved players have been doing lately)
+        hostname = self.get_hostnames()
+        summaries = self.get_activity_summaries(client, reason)
+        if category is None:
+            message = self.patterns['p3'] % (client.name, hostname['ts3'], reason)
+        else:
+            label = category['name'].upper()
+            message = self.patterns['p4'] % (label, client.name, hostname['ts3'], reason)
+        for summary in summaries:
+            # Teamspeak 3 rejects longer messages: attach summaries only while they fit
+            extra = self.patterns['p5'] % summary
+            if len((message + extra).encode('utf-8')) > self.message_length:
+                break
+            message += extra
+        if category is None:
+            sent['ts3'] = self.send_teamspeak_message(message)
+        else:
+            sent['ts3'] = self.send_teamspeak_message(message, category['route'])
+        if settings['useirc'] and self.ircbotPlugin:
             # broadcast also on the IRC network
-            hostname = convert_colors(self.settings['hostname'])
-            message = self.patterns['i3'] % (RESET, MAGENTA, RESET, ORANGE, client.name, RESET, hostname, ORANGE, reason)
+            if category is None:
+                message = self.patterns['i3'] % (RESET, MAGENTA, RESET, ORANGE, client.name, RESET, hostname['irc'], ORANGE, reason)
+            else:
+                message = self.patterns['i4'] % (RESET, MAGENTA, RESET, RED, label, RESET, ORANGE, client.name, RESET, hostname['irc'], ORANGE, reason)
+            message += ''.join([self.patterns['i5'] % (ORANGE, name, RESET, summary) for name, summary in summaries])
             sent['irc'] = self.send_irc_message(convert_colors(message))
 
         if sent['ts3'] or sent['irc']:
             # we consider the request as being sent if one of the above methods succeed
-            self.adminRequest = { 'client': client, 'reason': reason, 'time': int(time.time()) }
+            now = int(time.time())
+            if self.adminRequest is not None or self.ackRequest is not None:
+                # the previous request expired (or got superseded) without any admin showing up
+                self.stats.unanswered(now)
+            self.stats.request(now)
+            self.ackRequest = None
+            self.resolvedRequest = None
+            self.adminRequest = { 'client': client, 'reason': reason, 'time': now, 'category': category }
+            if category is not None:
+                self.categoryRequests[category['name']] = now
             client.message('^7Admin request ^2sent^7: an admin will connect as soon as possible')
+            # tell the player how many people received the request (only if we have a fresh view of the server)
+            presence = self.get_staff_presence()
+            if sent['ts3'] and presence is not None and not (category and category['route']):
+                if len(presence) == 0:
+                    client.message('^7Nobody is on ^3TS3 ^7at the moment')
+                else:
+                    who = 'admin' if settings['msg_mode'] != 'global' else 'client'
+                    client.message('^7%s %s%s on ^3TS3 ^7%s notified' % (len(presence), who,
+                                                                      's' if len(presence) != 1 else '',
+                                                                      'were' if len(presence) != 1 else 'was'))
         else:
             # both teamspeak and irc message couldn't be sent
             self.adminRequest = None
             client.message('^7Admin request ^1failed^7: try again in few minutes')
 
-########################################################################################################################
-#                                                                                                                      #
-#  TEAMSPEAK SERVER QUERY INTERFACE                                                                                    #
-#                                                                                                                      #
-########################################################################################################################
+    def cmd_calladminreload(self, data, client, cmd=None):
+        """
+        - reload the calladmin plugin configuration
+        """
+        if self.config.fileName:
+            try:
+                config = b3.config.load(self.config.fileName)
+                if config is None:
+                    raise b3.config.ConfigFileNotFound(self.config.fileName)
+            except Exception, e:
+                self.error('could not reload configuration file %s: %s' % (self.config.fileName, e))
+                client.message('^7Configuration ^1not reloaded^7: check B3 log file')
+                return
+            self.config = config
 
-# Copyright (c) 2009 Christoph Heer (Christoph.Heer@googlemail.com)
-#
-# Permission is hereby granted, free of charge, to any person obtaining a
-# copy of this software and associated documentation files (the "Software"),
-# to deal in the Software without restriction, including without limitation
-# the rights to use, copy, modify, merge, publish, distribute, sublicense,
-# and/or sell copies of the Software, and to permit persons to whom the
-# Software is furnished to do so, subject to the following conditions:
-#
-# The above copyright notice and this permission notice shall be included in
-# all copies or substantial portions of the Software.
-#
-# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
-# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
-# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
-# DEALINGS IN THE SOFTWARE.
+        self.onLoadConfig()
+        if self.settings['useirc'] and not self.ircbotPlugin:
+            self.ircbotPlugin = self.console.getPlugin('ircbot')
 
+        client.message('^7Configuration ^2reloaded')
 
-class TS3Error(Exception):
-    msg = None
-    msg2 = None
-    code = None
-    
-    def __init__(self, code, msg, msg2=None):
+    def cmd_calladminprofile(self, data, client, cmd=None):
         """
-        Object constructor
+        <on|off|dump> - profile the calladmin plugin
         """
-        self.code = code
-        self.msg = msg
-        self.msg2 = msg2
+        data = data.strip().lower()
+        running = self.profiler is not None and self.profiler.running
+        if data not in ('on', 'off', 'dump'):
+            client.message('^7Profiler is %s^7, usage: ^3!^7calladminprofile <on|off|dump>' %
+                           ('^2on' if running else '^1off'))
+            return
 
-    def __str__(self):
-        """
-        Object string representation
-        """
-        return "ID %s (%s) %s" % (self.code, self.msg, self.msg2)
+        if data == 'on':
+            if running:
+                client.message('^7Profiler is already ^2on')
+                return
+            self.start_profiler()
+            client.message('^7Profiler ^2started')
+        elif data == 'off':
+            if not running:
+                client.message('^7Profiler is already ^1off')
+                return
+            self.stop_profiler()
+            client.message('^7Profiler ^1stopped^7: type ^3!^7calladminprofile dump to save collected data')
+        else:
+            if running:
+                # this command is itself being profiled: its profile can't be collected while it runs
+                client.message('^7Profiler is ^2on^7: type ^3!^7calladminprofile off before saving collected data')
+                return
+            if self.profiler is None or not self.profiler.calls:
+                client.message('^7No profiling data available: type ^3!^7calladminprofile on to start the profiler')
+                return
+            path = b3.getWritableFilePath(self.settings['profile_file'])
+            try:
+                stats = self.profiler.dump(path)
+            except (IOError, OSError), e:
+                self.error('could not save profiling data in %s: %s' % (path, e))
+                client.message('^7Profiling data ^1not saved^7: check B3 log file')
+                return
+            self.info('profiling data (%s calls) saved in %s' % (self.profiler.calls, path))
+            client.message('^7Profiling data ^2saved^7: %s' % path)
+            for line in stats:
+                self.debug(line)
 
+########################################################################################################################
+#                                                                                                                      #
+#  TEAMSPEAK SESSION                                                                                                   #
+#                                                                                                                      #
+########################################################################################################################
 
-class ServerQuery(object):
+class TeamspeakSession(object):
 
     _ip = None
+    _port = None
+    _serverid = None
+    _username = None
+    _password = None
+    _capture = None
     _query = None
-    _timeout = None
-    _telnet = None
-
-    _tsregex = re.compile(r"(\w+)=(.*?)(\s|$|\|)")
-    _lock = thread.allocate_lock()
+    _channelid = None
+    _joined = None
 
-    def __init__(self, ip='127.0.0.1', query=10011):
+    def __init__(self, ip, port, serverid, username, password, capture=None, channelid=None):
         """
-        Object constructor
+        Object constructor.
+        The server query connection is established on the first command and
+        transparently re-established if the Teamspeak 3 server closes it.
+        :param channelid: If given, the server query client joins this channel on connect
         """
         self._ip = ip
-        self._query = int(query)
-        self._timeout = 5.0
-
-    def connect(self):
+        self._port = port
+        self._serverid = serverid
+        self._username = username
+        self._password = password
+        self._capture = capture
+        self._channelid = channelid
+        self._lock = thread.allocate_lock()
+
+    def _connect(self):
         """
-        Open a link to the Teamspeak 3 query port
+        Open the server query connection and select the virtual server.
         """
+        sq = ServerQuery(self._ip, self._port, self._capture)
+        sq.connect()
         try:
-            self._telnet = telnetlib.Telnet(self._ip, self._query)
-        except telnetlib.socket.error, e:
-            raise TS3Error(10, 'could not connect to the teamspeak 3 server query', e)
-
-        output = self._telnet.read_until('TS3', self._timeout)
-        if not output.endswith('TS3'):
-            raise TS3Error(20, 'this is not a teamspeak 3 server query interface')
-
-        return True
-
-    def disconnect(self):
+            sq.command('login', {'client_login_name': self._username, 'client_login_password': self._password})
+            sq.command('use', {'sid': self._serverid})
+            self._joined = None
+            if self._channelid is not None:
+                self._move(sq, self._channelid)
+        except (TS3Error, EOFError, telnetlib.socket.error):
+            self._discard(sq)
+            raise
+        self._query = sq
+
+    def _move(self, sq, channelid):
         """
-        Close the link to the Teamspeak 3 query port
+        Move the server query client to the given channel.
         """
-        if self._telnet is not None:
-            self._telnet.write('quit \n')
-            self._telnet.close()
-        return True
+        whoami = sq.command('whoami')
+        try:
+            sq.command('clientmove', {'clid': whoami['client_id'], 'cid': channelid})
+        except TS3Error, e:
+            if e.code != 770:  # already member of channel
+                raise
+        self._joined = channelid
 
     @staticmethod
-    def escaping2string(string):
+    def _discard(sq):
+        """
+        Close a server query connection ignoring errors.
+        """
+        try:
+            sq.disconnect()
+        except (EOFError, telnetlib.socket.error):
+            pass
+
+    def command(self, cmd, parameter=None, option=None):
+        """
+        Send a command over the session (same signature as ServerQuery.command).
+        """
+        return self._execute(lambda sq: sq.command(cmd, parameter, option))
+
+    def pipeline(self, commands):
+        """
+        Send a batch of commands over the session (same signature as ServerQuery.pipeline).
+        """
+        return self._execute(lambda sq: sq.pipeline(commands))
+
+    def join(self, channelid):
+        """
+        Move the server query client to the given channel (channel messages are delivered to the channel
+        the server query client is in): the channel is joined again if the connection is re-established.
+        """
+        self._execute(lambda sq: self._join(sq, channelid))
+
+    def channel_command(self, channelid, cmd, parameter=None, option=None):
+        """
+        Join the given channel and send a command from there: both happen while holding the session,
+        so no other thread can move the server query client to another channel in between.
+        """
+        def channel_command(sq):
+            self._join(sq, channelid)
+            return sq.command(cmd, parameter, option)
+
+        return self._execute(channel_command)
+
+    def _join(self, sq, channelid):
+        """
+        Join the given channel unless the server query client is already there.
+        """
+        self._channelid = channelid
+        if self._joined != channelid:
+            self._move(sq, channelid)
+
+    def _execute(self, func):
+        """
+        Execute func over the server query connection (connecting if needed).
+        """
+        self._lock.acquire()
+        try:
+            if self._query is None:
+                self._connect()
+                return func(self._query)
+            try:
+                return func(self._query)
+            except (EOFError, telnetlib.socket.error):
+                # the connection went stale (idle timeout, server restart): retry once
+                self._discard(self._query)
+                self._query = None
+                self._connect()
+                return func(self._query)
+        except (EOFError, telnetlib.socket.error):
+            if self._query is not None:
+                self._discard(self._query)
+                self._query = None
+            raise
+        except TS3Error, e:
+            if e.code == 12 and self._query is not None:
+                # incomplete reply: what is left of it would be read as the reply of the next
+                # command, so the connection is dropped (the next command opens a new one)
+                self._discard(self._query)
+                self._query = None
+            raise
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Close the session.
+        """
+        self._lock.acquire()
+        try:
+            if self._query is not None:
+                self._discard(self._query)
+                self._query = None
+        finally:
+            self._lock.release()
+
+
+class TeamspeakTarget(object):
+
+    # settings identifying the target
+    keys = ('ip', 'port', 'serverid', 'username', 'password', 'msg_groupid', 'msg_mode', 'msg_channelid')
+    connection = ('ip', 'port', 'serverid', 'username', 'password')
+    strategy = ('msg_mode', 'msg_groupid', 'msg_channelid')
+    modes = ('global', 'group', 'channel', 'poke')
+
+    # maximum length of a poke message
+    poke_length = 100
+
+    settings = None
+    presence = None
+    send = None
+
+    def __init__(self, settings, capture=None):
+        """
+        Object constructor.
+        :param settings: The target settings dict (name plus the options listed in TeamspeakTarget.keys)
+        :param capture: An optional ServerQueryCapture recording the traffic
+        """
+        self.name = settings['name']
+        self.session = TeamspeakSession(settings['ip'], settings['port'], settings['serverid'],
+                                        settings['username'], settings['password'], capture,
+                                        self.get_channel(settings))
+        self.configure(settings)
+
+    @staticmethod
+    def get_channel(settings):
+        """
+        Return the channel the server query client has to join (None if not using channel mode).
+        """
+        return settings['msg_channelid'] if settings['msg_mode'] == 'channel' else None
+
+    def configure(self, settings):
+        """
+        Apply new target settings: the message strategy is swapped only if the delivery settings changed.
+        """
+        if self.settings is None or [self.settings[x] for x in self.strategy] != [settings[x] for x in self.strategy]:
+            self.send = getattr(self, '_send_%s_message' % settings['msg_mode'])
+            self.presence = None
+        self.settings = settings
+
+    def same_connection(self, settings):
+        """
+        Tell whether the given settings refer to the same server query session.
+        """
+        return all([self.settings[x] == settings[x] for x in self.connection]) and \
+            self.get_channel(self.settings) == self.get_channel(settings)
+
+    def get_route(self, route=None):
+        """
+        Return the (send, settings) pair delivering a request with the given routing overrides.
+        :param route: An optional dict overriding msg_mode, msg_groupid and msg_channelid
+        """
+        if not route:
+            return self.send, self.settings
+        settings = dict(self.settings, **route)
+        return getattr(self, '_send_%s_message' % settings['msg_mode']), settings
+
+    def get_clients(self, settings=None):
+        """
+        Return the clients receiving admin requests on this target.
+        """
+        settings = settings or self.settings
+        if settings['msg_mode'] == 'channel':
+            channelid = settings['msg_channelid']
+            return [x for x in CalladminPlugin.get_teamspeak_clients(self.session) if x.get('cid') == channelid]
+        return CalladminPlugin.get_teamspeak_clients(self.session, settings['msg_groupid'])
+
+    def set_presence(self, clients, when):
+        """
+        Store the list of clients receiving admin requests on this target.
+        """
+        self.presence = {'time': when, 'clients': clients}
+
+    def _deliver(self, commands):
+        """
+        Send a batch of commands in a single round trip.
+        Will raise the first error only if none of the commands succeeded.
+        """
+        if not commands:
+            return
+        errors = [x for x in self.session.pipeline(commands) if isinstance(x, TS3Error)]
+        if len(errors) == len(commands):
+            raise errors[0]
+
+    def _send_global_message(self, message, settings=None):
+        """
+        Send a global message over the Teamspeak 3 server.
+        """
+        self.session.command('sendtextmessage', {'targetmode': 3, 'target': 1, 'msg': message})
+
+    def _send_channel_message(self, message, settings=None):
+        """
+        Send a message in the staff channel (the server query client joins it only if it's not already there).
+        """
+        channelid = (settings or self.settings)['msg_channelid']
+        self.session.channel_command(channelid, 'sendtextmessage', {'targetmode': 2, 'target': channelid, 'msg': message})
+
+    def _send_group_message(self, message, settings=None):
+        """
+        Send a private message to all the people belonging to the target server group.
+        """
+        self._deliver([('sendtextmessage', {'targetmode': 1, 'target': x['clid'], 'msg': message})
+                       for x in self.get_clients(settings)])
+
+    def _send_poke_message(self, message, settings=None):
+        """
+        Poke all the people belonging to the target server group.
+        """
+        message = message[:self.poke_length]
+        self._deliver([('clientpoke', {'clid': x['clid'], 'msg': message}) for x in self.get_clients(settings)])
+
+    def close(self):
+        """
+        Close the target server query session.
+        """
+        self.session.close()
+
+
+class TeamspeakListener(object):
+
+    # seconds between two reads (to check whether the listener has been stopped)
+    poll = 5
+    # seconds of inactivity after which a keepalive command is sent
+    keepalive = 240
+    # initial and maximum seconds to wait before reconnecting
+    backoff = (5, 300)
+
+    _query = None
+    _thread = None
+    # client id of the listener server query client
+    _clid = None
+
+    def __init__(self, plugin, settings, capture=None):
+        """
+        Object constructor.
+        Listen for text messages on a dedicated server query connection: notifications can be pushed
+        at any time, thus they can't share the connection used to send commands and parse replies.
+        :param plugin: The plugin notified through on_teamspeak_text
+        :param settings: The Teamspeak 3 settings dict
+        :param capture: An optional ServerQueryCapture recording the traffic
+        """
+        self.plugin = plugin
+        self.settings = settings
+        self.capture = capture
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Start listening in a separate thread.
+        """
+        self._thread = threading.Thread(target=self.run, name='calladmin-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop listening (the thread exits at the next poll).
+        """
+        self._stop.set()
+
+    def _connect(self):
+        """
+        Open the server query connection and register for text messages notifications.
+        """
+        settings = self.settings
+        sq = ServerQuery(settings['ip'], settings['port'], self.capture)
+        self._query = sq
+        sq.connect()
+        sq.command('login', {'client_login_name': settings['username'],
+                             'client_login_password': settings['password']})
+        sq.command('use', {'sid': settings['serverid']})
+        whoami = sq.command('whoami')
+        self._clid = whoami['client_id']
+        if settings['msg_mode'] == 'channel':
+            # channel messages are notified only for the channel the server query client is in
+            try:
+                sq.command('clientmove', {'clid': whoami['client_id'], 'cid': settings['msg_channelid']})
+            except TS3Error, e:
+                if e.code != 770:  # already member of channel
+                    raise
+        for event in ('textprivate', 'textchannel', 'textserver'):
+            sq.command('servernotifyregister', {'event': event})
+
+    def _listen(self):
+        """
+        Read notifications until the listener is stopped or the connection drops.
+        """
+        idle = 0
+        while not self._stop.isSet():
+            line = self._query.receive(self.poll)
+            if line is None:
+                idle += self.poll
+                if idle >= self.keepalive:
+                    # the Teamspeak 3 server drops idle server query clients
+                    self._query.send('whoami')
+                    idle = 0
+                continue
+            if line.startswith('notifytextmessage'):
+                name, data = ServerQuery.parse_event(line)
+                if data.get('invokerid') == self._clid:
+                    # our own messages are notified too
+                    continue
+                self.plugin.on_teamspeak_text(data)
+
+    def run(self):
+        """
+        Listener thread main loop: reconnect with an exponential backoff when the connection is lost.
+        """
+        delay = self.backoff[0]
+        while not self._stop.isSet():
+            try:
+                self._connect()
+                self.plugin.debug('Teamspeak 3 listener connected')
+                delay = self.backoff[0]
+                self._listen()
+            except (TS3Error, EOFError, telnetlib.socket.error), e:
+                if not self._stop.isSet():
+                    self.plugin.warning('Teamspeak 3 listener disconnected (%s): retrying in %s seconds' % (e, delay))
+            finally:
+                if self._query is not None:
+                    TeamspeakSession._discard(self._query)
+                    self._query = None
+            self._stop.wait(delay)
+            delay = min(delay * 2, self.backoff[1])
+
+
+########################################################################################################################
+#                                                                                                                      #
+#  REASON CLASSIFIER                                                                                                   #
+#                                                                                                                      #
+########################################################################################################################
+
+class ReasonClassifier(object):
+
+    regex = None
+
+    def __init__(self, categories):
+        """
+        Object constructor.
+        The patterns of all the categories are compiled in a single alternation (one named group per
+        category) so that a reason is classified in one pass whatever the number of categories.
+        Every alternative is a zero-width lookahead, so matches don't consume the reason and overlapping
+        candidates are all seen: alternatives are sorted by priority, so that when several categories
+        match at the same position the one with the highest priority is reported.
+        :param categories: A list of category dicts (name, patterns, priority, treshold, route)
+        """
+        self.categories = {}
+        alternatives = []
+        for index, category in enumerate(sorted(categories, key=lambda x: -x['priority'])):
+            group = 'c%d' % index
+            self.categories[group] = category
+            alternatives.append('(?=(?P<%s>%s))' % (group, '|'.join(['(?:%s)' % x for x in category['patterns']])))
+        if alternatives:
+            self.regex = re.compile('|'.join(alternatives), re.IGNORECASE | re.UNICODE)
+
+    def classify(self, reason):
+        """
+        Return the category matching the given reason (the one with the highest priority if
+        more than one category matches) or None if the reason doesn't match any category.
+        """
+        if self.regex is None:
+            return None
+        category = None
+        for match in self.regex.finditer(reason):
+            candidate = self.categories[match.lastgroup]
+            if category is None or candidate['priority'] > category['priority']:
+                category = candidate
+        return category
+
+
+########################################################################################################################
+#                                                                                                                      #
+#  PLAYER ACTIVITY                                                                                                     #
+#                                                                                                                      #
+########################################################################################################################
+
+class ActivityRecord(object):
+
+    __slots__ = ('time', 'kind', 'text')
+
+    # maximum length of the recorded chat lines
+    length = 40
+
+    def __init__(self, when, kind, text):
+        """
+        Object constructor.
+        :param when: The time the activity happened at
+        :param kind: The kind of activity (say, team say, kill, team kill, killed by, team)
+        :param text: The activity details (chat line, victim or killer name, team)
+        """
+        self.time = when
+        self.kind = kind
+        self.text = text[:self.length]
+
+    def describe(self, now):
+        """
+        Return a short human readable description of the record.
+        """
+        if self.kind in ('say', 'team say'):
+            return '%s "%s" %ds ago' % (self.kind, self.text, now - self.time)
+        return '%s %s %ds ago' % (self.kind, self.text, now - self.time)
+
+
+class PlayerActivity(object):
+
+    def __init__(self, size, players):
+        """
+        Object constructor.
+        Keep the last size records of the last players active players: the least recently
+        active player is dropped when a new one shows up, so memory is capped whatever the churn.
+        :param size: The number of records kept for each player (0 disables recording)
+        :param players: The maximum number of players tracked
+        """
+        self.size = size
+        self.players = players
+        self._buffers = OrderedDict()
+
+    @staticmethod
+    def key(client):
+        """
+        Return the key identifying a player (stable across reconnections).
+        """
+        return client.guid or client.cid
+
+    def add(self, client, when, kind, text):
+        """
+        Append an activity record to the player buffer.
+        """
+        if not self.size:
+            return
+        key = self.key(client)
+        buf = self._buffers.pop(key, None)
+        if buf is None:
+            buf = deque(maxlen=self.size)
+            if len(self._buffers) >= self.players:
+                self._buffers.popitem(last=False)
+        buf.append(ActivityRecord(when, kind, text))
+        self._buffers[key] = buf
+
+    def get(self, client, limit=None):
+        """
+        Return the most recent activity records of a player (oldest first).
+        """
+        buf = self._buffers.get(self.key(client))
+        if not buf:
+            return []
+        records = list(buf)
+        return records[-limit:] if limit else records
+
+    def __len__(self):
+        return len(self._buffers)
+
+
+########################################################################################################################
+#                                                                                                                      #
+#  STATISTICS                                                                                                          #
+#                                                                                                                      #
+########################################################################################################################
+
+class RollingCounter(object):
+
+    def __init__(self, size, width):
+        """
+        Object constructor.
+        Count events over a sliding window made of size buckets, each one width seconds long:
+        expired buckets are cleared while the window slides, so both add and total are O(1) amortized.
+        """
+        self.size = size
+        self.width = width
+        self.total = 0
+        self._counts = [0] * size
+        self._last = None
+
+    def _advance(self, now):
+        """
+        Slide the window up to the given time clearing expired buckets.
+        """
+        index = int(now // self.width)
+        if self._last is None or index < self._last:
+            # first event (or clock moved backwards): start sliding from here
+            index = self._last = max(index, self._last)
+        elif index > self._last:
+            for i in xrange(self._last + 1, self._last + 1 + min(index - self._last, self.size)):
+                slot = i % self.size
+                self.total -= self._counts[slot]
+                self._counts[slot] = 0
+            self._last = index
+        return index % self.size
+
+    def add(self, now, value=1):
+        """
+        Count an event happened at the given time.
+        """
+        self._counts[self._advance(now)] += value
+        self.total += value
+
+    def count(self, now):
+        """
+        Return the number of events in the window ending at the given time.
+        """
+        self._advance(now)
+        return self.total
+
+
+class P2Quantile(object):
+
+    def __init__(self, p=0.5):
+        """
+        Object constructor.
+        Estimate a quantile over a stream of observations using the P-square algorithm (Jain & Chlamtac):
+        only five markers are stored and every observation is processed in O(1).
+        :param p: The quantile to be estimated (0.5 = median)
+        """
+        self.p = p
+        self.count = 0
+        self._q = []
+        self._n = [0, 1, 2, 3, 4]
+        self._np = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self._dn = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        """
+        Add an observation.
+        """
+        self.count += 1
+        q, n = self._q, self._n
+        if self.count <= 5:
+            bisect.insort(q, x)
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(q, x) - 1
+
+        for i in xrange(k + 1, 5):
+            n[i] += 1
+        for i in xrange(5):
+            self._np[i] += self._dn[i]
+
+        # adjust the heights of the three central markers
+        for i in (1, 2, 3):
+            d = self._np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = self._parabolic(i, d)
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + d * (q[i + d] - q[i]) / float(n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        """
+        Return the piecewise-parabolic prediction of a marker height.
+        """
+        q, n = self._q, self._n
+        return q[i] + d / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
+
+    def value(self):
+        """
+        Return the current estimate (None if nothing has been observed yet).
+        """
+        if not self.count:
+            return None
+        if self.count <= 5:
+            # exact value (nearest rank) until the markers are initialized
+            return self._q[max(0, int(math.ceil(self.p * self.count)) - 1)]
+        return self._q[2]
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        """
+        Object constructor.
+        Admin requests statistics updated incrementally by the plugin: no history is stored.
+        """
+        self.hour = RollingCounter(60, 60)
+        self.day = RollingCounter(24, 3600)
+        self.missed = RollingCounter(24, 3600)
+        self.arrivals = P2Quantile(0.5)
+        self._lock = thread.allocate_lock()
+
+    def request(self, now):
+        """
+        Count an admin request.
+        """
+        self._lock.acquire()
+        try:
+            self.hour.add(now)
+            self.day.add(now)
+        finally:
+            self._lock.release()
+
+    def arrival(self, elapsed):
+        """
+        Record the time an admin took to show up after an admin request.
+        """
+        self._lock.acquire()
+        try:
+            self.arrivals.add(elapsed)
+        finally:
+            self._lock.release()
+
+    def unanswered(self, now):
+        """
+        Count an admin request which was closed without any admin showing up.
+        """
+        self._lock.acquire()
+        try:
+            self.missed.add(now)
+        finally:
+            self._lock.release()
+
+    def summary(self, now):
+        """
+        Return a dict summarizing the statistics at the given time.
+        """
+        self._lock.acquire()
+        try:
+            return {'hour': self.hour.count(now), 'day': self.day.count(now),
+                    'unanswered': self.missed.count(now), 'median': self.arrivals.value()}
+        finally:
+            self._lock.release()
+
+
+########################################################################################################################
+#                                                                                                                      #
+#  PROFILER                                                                                                            #
+#                                                                                                                      #
+########################################################################################################################
+
+class CalladminProfiler(object):
+
+    running = False
+
+    def __init__(self):
+        """
+        Object constructor.
+        Every thread running profiled code gets its own cProfile.Profile: they are merged on dump.
+        """
+        self.calls = 0
+        self._profiles = {}
+        self._local = threading.local()
+        self._lock = thread.allocate_lock()
+
+    def _get_profile(self):
+        """
+        Return the (profile, lock) tuple of the current thread.
+        """
+        ident = thread.get_ident()
+        self._lock.acquire()
+        try:
+            if ident not in self._profiles:
+                self._profiles[ident] = (cProfile.Profile(), thread.allocate_lock())
+            return self._profiles[ident]
+        finally:
+            self._lock.release()
+
+    def wrap(self, func):
+        """
+        Return a wrapper which executes func under the profiler (the original is kept in wrapper.profiled).
+        """
+        local = self._local
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(local, 'active', False):
+                # nested entry point: already being profiled
+                return func(*args, **kwargs)
+            profile, lock = self._get_profile()
+            local.active = True
+            lock.acquire()
+            try:
+                self.calls += 1
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                lock.release()
+                local.active = False
+
+        wrapper.profiled = func
+        return wrapper
+
+    def dump(self, path, limit=10):
+        """
+        Save collected data in pstats format and return the summary of the most expensive calls.
+        Must not be called by profiled code (the profile of the calling thread would be locked).
+        :param path: The file where to save profiling data
+        :param limit: The number of calls to be listed in the summary
+        """
+        self._lock.acquire()
+        try:
+            profiles = self._profiles.values()
+        finally:
+            self._lock.release()
+
+        stats = None
+        for profile, lock in profiles:
+            lock.acquire()
+            try:
+                profile.create_stats()
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            finally:
+                lock.release()
+
+        stats.dump_stats(path)
+        stats.stream = StringIO()
+        stats.sort_stats('cumulative').print_stats(limit)
+        return [x for x in stats.stream.getvalue().splitlines() if x.strip()]
+
+########################################################################################################################
+#                                                                                                                      #
+#  TEAMSPEAK SERVER QUERY INTERFACE                                                                                    #
+#                                                                                                                      #
+########################################################################################################################
+
+# Copyright (c) 2009 Christoph Heer (Christoph.Heer@googlemail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+class TS3Error(Exception):
+    msg = None
+    msg2 = None
+    code = None
+    
+    def __init__(self, code, msg, msg2=None):
+        """
+        Object constructor
+        """
+        self.code = code
+        self.msg = msg
+        self.msg2 = msg2
+
+    def __str__(self):
+        """
+        Object string representation
+        """
+        return "ID %s (%s) %s" % (self.code, self.msg, self.msg2)
+
+
+class ServerQuery(object):
+
+    _ip = None
+    _query = None
+    _timeout = None
+    _telnet = None
+    _capture = None
+    _connected = None
+    _pending = ''
+
+    _tsregex = re.compile(r"(\w+)=(.*?)(\s|$|\|)")
+    _lock = None
+
+    def __init__(self, ip='127.0.0.1', query=10011, capture=None):
+        """
+        Object constructor
+        :param capture: An optional ServerQueryCapture recording the traffic
+        """
+        self._ip = ip
+        self._query = int(query)
+        self._timeout = 5.0
+        self._capture = capture
+        # one lock per link: sessions towards different servers must not serialize each other
+        self._lock = thread.allocate_lock()
+
+    def connect(self):
+        """
+        Open a link to the Teamspeak 3 query port
+        """
+        try:
+            self._telnet = telnetlib.Telnet(self._ip, self._query)
+        except telnetlib.socket.error, e:
+            raise TS3Error(10, 'could not connect to the teamspeak 3 server query', e)
+
+        start = self._connected = time.time()
+        output = self._telnet.read_until('TS3', self._timeout)
+        if self._capture is not None:
+            self._capture.record(0.0, time.time() - start, None, output)
+        if not output.endswith('TS3'):
+            raise TS3Error(20, 'this is not a teamspeak 3 server query interface')
+
+        return True
+
+    def disconnect(self):
+        """
+        Close the link to the Teamspeak 3 query port
+        """
+        if self._telnet is not None:
+            self._telnet.write('quit \n')
+            self._telnet.close()
+        return True
+
+    @staticmethod
+    def escaping2string(string):
         """
         Convert the escaping string form the TS3 Query to a human string
         """
@@ -577,6 +2262,94 @@ class ServerQuery(object):
         """
         Send a command with parameters and options to the TS3 Query
         """
+        telnet_cmd = self.format(cmd, parameter, option)
+        self._lock.acquire()
+        
+        try:
+            start = time.time()
+            self._telnet.write(telnet_cmd)
+            telnet_response = self._read_reply()
+            if self._capture is not None:
+                self._capture.record(start - self._connected, time.time() - start, telnet_cmd, telnet_response)
+        finally:
+            self._lock.release()
+        
+        return self.parse(cmd, telnet_response)
+
+    def pipeline(self, commands):
+        """
+        Send a batch of commands to the TS3 Query in a single write and collect their replies.
+        Return a list holding, for each command, either the parsed reply or the TS3Error it raised.
+        :param commands: A list of (cmd, parameter, option) tuples (parameter and option may be omitted)
+        """
+        telnet_cmds = [self.format(*x) for x in commands]
+        telnet_responses = []
+        self._lock.acquire()
+
+        try:
+            start = time.time()
+            self._telnet.write(''.join(telnet_cmds))
+            for telnet_cmd in telnet_cmds:
+                telnet_responses.append(self._read_reply())
+                if self._capture is not None:
+                    self._capture.record(start - self._connected, time.time() - start, telnet_cmd,
+                                         telnet_responses[-1])
+        finally:
+            self._lock.release()
+
+        results = []
+        for command, telnet_response in zip(commands, telnet_responses):
+            try:
+                results.append(self.parse(command[0], telnet_response))
+            except TS3Error, e:
+                results.append(e)
+        return results
+
+    def send(self, cmd, parameter=None, option=None):
+        """
+        Send a command to the TS3 Query without waiting for its reply (see receive)
+        """
+        self._lock.acquire()
+        try:
+            self._telnet.write(self.format(cmd, parameter, option))
+        finally:
+            self._lock.release()
+
+    def receive(self, timeout):
+        """
+        Return the next line sent by the TS3 Query (None if no complete line arrives within timeout)
+        """
+        self._pending += self._telnet.read_until('\n\r', timeout)
+        if not self._pending.endswith('\n\r'):
+            return None
+        line, self._pending = self._pending[:-2].lstrip('\n\r'), ''
+        return line
+
+    @classmethod
+    def parse_event(cls, line):
+        """
+        Parse a TS3 Query notification line returning its name and its parameters dict
+        """
+        name, _, data = line.partition(' ')
+        return name, dict([(x[0], cls.escaping2string(x[1])) for x in cls._tsregex.findall(data)])
+
+    def _read_reply(self):
+        """
+        Read a complete reply (data lines up to the error line) from the TS3 Query
+        """
+        telnet_response = ''
+        while True:
+            line = self._telnet.read_until('\n\r', self._timeout)
+            if not line.endswith('\n\r'):
+                raise TS3Error(12, "bad TS3 response : %r" % (telnet_response + line))
+            telnet_response += line
+            if line.lstrip().startswith('error id='):
+                return telnet_response
+
+    def format(self, cmd, parameter=None, option=None):
+        """
+        Return the TS3 Query command line for the given command, parameters and options
+        """
         if parameter is None:
             parameter = {}
 
@@ -589,15 +2362,12 @@ class ServerQuery(object):
         for i in option:
             telnet_cmd += " -%s" % i
             
-        telnet_cmd += '\n'
-        self._lock.acquire()
-        
-        try:
-            self._telnet.write(telnet_cmd)
-            telnet_response = self._telnet.read_until("msg=ok", self._timeout)
-        finally:
-            self._lock.release()
-        
+        return telnet_cmd + '\n'
+
+    def parse(self, cmd, telnet_response):
+        """
+        Parse a TS3 Query reply (raise TS3Error if the command failed)
+        """
         telnet_response = telnet_response.split(r'error id=')
         
         try:
@@ -630,3 +2400,71 @@ class ServerQuery(object):
             raise TS3Error(return_cmd_status['id'], return_cmd_status['msg'], return_cmd_status)
 
         return return_info
+
+
+########################################################################################################################
+#                                                                                                                      #
+#  SERVER QUERY CAPTURE                                                                                                #
+#                                                                                                                      #
+########################################################################################################################
+
+class ServerQueryCapture(object):
+
+    _passregex = re.compile(r'(client_login_password=)\S+')
+
+    def __init__(self, path):
+        """
+        Object constructor.
+        Every server query exchange is appended to the given file as a JSON line:
+        {"t": <seconds since connect>, "d": <reply time>, "c": <command>, "r": <raw reply>}
+        The greeting sent by the server on connect is stored with a null command.
+        :param path: The path of the capture file
+        """
+        self.path = path
+        self._lock = thread.allocate_lock()
+
+    @classmethod
+    def sanitize(cls, command):
+        """
+        Remove the server query password from the given command line.
+        """
+        if command is None:
+            return None
+        command = command.strip()
+        if command.startswith('login '):
+            command = cls._passregex.sub(r'\1***', command)
+            parts = command.split(' ')
+            if len(parts) == 3 and '=' not in parts[2]:
+                # 'login <username> <password>' syntax
+                command = '%s %s ***' % (parts[0], parts[1])
+        return command
+
+    def record(self, offset, elapsed, command, reply):
+        """
+        Append a server query exchange to the capture file.
+        :param offset: Seconds elapsed since the connection was established
+        :param elapsed: Seconds elapsed waiting for the reply
+        :param command: The command sent to the server query (None for the greeting)
+        :param reply: The raw reply
+        """
+        line = json.dumps({'t': round(offset, 4), 'd': round(elapsed, 4), 'c': self.sanitize(command),
+                           'r': reply.decode('utf-8', 'replace')}, separators=(',', ':'))
+        self._lock.acquire()
+        try:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def load(path):
+        """
+        Load the server query exchanges stored in a capture file.
+        """
+        records = []
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+        return records
@@ -0,0 +1,139 @@
+#
+# Calladmin Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import thread
+import threading
+import SocketServer
+
+from calladmin import ServerQueryCapture
+
+
+class ServerQueryReplay(object):
+
+    greeting = 'TS3\n\rWelcome to the TeamSpeak 3 ServerQuery interface.\n\r'
+    unknown = 'error id=256 msg=command\\snot\\sfound\n\r'
+
+    def __init__(self, records, ip='127.0.0.1', port=0, speed=1.0, latency=0.0):
+        """
+        Object constructor.
+        Serve captured server query replies back to ServerQuery clients: commands are matched
+        against the capture (password excluded) and, failing that, by command name only.
+        Replies for the same command are served in the recorded order, cycling when exhausted.
+        :param records: The list of records loaded through ServerQueryCapture.load()
+        :param speed: Replay speed factor (1.0 = recorded timings, 0 = no delay at all)
+        :param latency: Additional delay (in seconds) injected before every reply
+        """
+        self.speed = speed
+        self.latency = latency
+        self.served = {}
+        self._replies = {}
+        self._cursor = {}
+        self._lock = thread.allocate_lock()
+        self._stop = threading.Event()
+        self._serving = False
+        for record in records:
+            if record['c'] is None:
+                self.greeting = record['r'].encode('utf-8')
+                continue
+            reply = (record['d'], record['r'].encode('utf-8'))
+            command = self.normalize(record['c'])
+            self._replies.setdefault(command, []).append(reply)
+            name = command.split(' ', 1)[0]
+            if name != command:
+                self._replies.setdefault(name, []).append(reply)
+
+        replay = self
+
+        class ReplayHandler(SocketServer.StreamRequestHandler):
+
+            def handle(self):
+                replay.delay(0.0)
+                self.wfile.write(replay.greeting)
+                while not replay._stop.isSet():
+                    line = self.rfile.readline()
+                    if not line or line.strip() == 'quit':
+                        break
+                    elapsed, reply = replay.lookup(line)
+                    replay.delay(elapsed)
+                    self.wfile.write(reply)
+
+        self.server = SocketServer.ThreadingTCPServer((ip, port), ReplayHandler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+
+    @staticmethod
+    def normalize(command):
+        """
+        Return the matching key of a command line (parameters are sorted since their order is not relevant).
+        """
+        parts = ServerQueryCapture.sanitize(command).split(' ')
+        return ' '.join(parts[:1] + sorted(parts[1:]))
+
+    @property
+    def address(self):
+        """
+        Return the (ip, port) tuple the replay server is listening on.
+        """
+        return self.server.server_address
+
+    def lookup(self, line):
+        """
+        Return the (elapsed, reply) tuple to be served for the given command line.
+        """
+        command = self.normalize(line)
+        self._lock.acquire()
+        try:
+            name = command.split(' ', 1)[0]
+            self.served[name] = self.served.get(name, 0) + 1
+            for key in (command, name):
+                if key in self._replies:
+                    replies = self._replies[key]
+                    index = self._cursor.get(key, 0)
+                    self._cursor[key] = (index + 1) % len(replies)
+                    return replies[index]
+            return 0.0, self.unknown
+        finally:
+            self._lock.release()
+
+    def delay(self, elapsed):
+        """
+        Wait before serving a reply (interrupted when the replay server is stopped).
+        """
+        wait = elapsed * self.speed + self.latency
+        if wait > 0:
+            self._stop.wait(wait)
+
+    def start(self):
+        """
+        Start serving in a separate thread.
+        """
+        self._serving = True
+        thread.start_new_thread(self.server.serve_forever, ())
+        return self.address
+
+    def stop(self):
+        """
+        Stop the replay server.
+        """
+        self._stop.set()
+        if self._serving:
+            self._serving = False
+            self.server.shutdown()
+        self.server.server_close()
@@ -16,19 +16,25 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import b3.events
+import os
 import time
+import shutil
+import tempfile
 from mock import Mock
 from mockito import when
 from textwrap import dedent
 from tests import CalladminTestCase
 from tests import logging_disabled
 from calladmin import CalladminPlugin
+from calladmin import ReasonClassifier
 from calladmin import RESET
 from calladmin import MAGENTA
 from calladmin import RESET
 from calladmin import ORANGE
 from calladmin import RESET
 from calladmin import ORANGE
+from calladmin import RED
 from b3.config import CfgConfigParser
 
 
@@ -50,8 +56,22 @@ class Test_commands(CalladminTestCase):
             treshold: 3600
             useirc: yes
 
+            [category:cheating]
+            keywords: aimbot, wallhack, cheater
+            regex: \bhack(s|ing)?\b
+            priority: 10
+            treshold: 300
+            msg_groupid: 9
+
+            [category:spam]
+            keywords: spam, spamming
+            priority: 1
+            treshold: 60
+
             [commands]
             calladmin: user
+            calladminreload: superadmin
+            calladminprofile: superadmin
         """))
 
         self.mockIrcbotPlugin = Mock()
@@ -66,6 +86,7 @@ class Test_commands(CalladminTestCase):
 
         self.mike = FakeClient(console=self.console, name="Mike", guid="mikeguid", groupBits=1)
         self.bill = FakeClient(console=self.console, name="Bill", guid="billguid", groupBits=16)
+        self.fenix = FakeClient(console=self.console, name="Fenix", guid="fenixguid", groupBits=128)
 
     ####################################################################################################################
     ##                                                                                                                ##
@@ -140,4 +161,218 @@ class Test_commands(CalladminTestCase):
         self.mike.says("!calladmin test reason")
         # THEN
         self.assertListEqual(['Admin already online: Bill [40]'], self.mike.message_history)
-        self.assertIsNone(self.p.adminRequest)
\ No newline at end of file
+        self.assertIsNone(self.p.adminRequest)
+
+    def test_cmd_calladmin_with_staff_presence(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.p.targets[0].set_presence([{'clid': 1}, {'clid': 2}, {'clid': 3}], time.time())
+        when(self.p).send_teamspeak_message(self.p.patterns['p3'] % ('Mike', 'Test Server', 'test reason')).thenReturn(True)
+        when(self.p).send_irc_message(self.p.patterns['i3'] % (RESET, MAGENTA, RESET, ORANGE, 'Mike', RESET, 'Test Server', ORANGE, 'test reason')).thenReturn(True)
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!calladmin test reason")
+        # THEN
+        self.assertListEqual(['Admin request sent: an admin will connect as soon as possible',
+                              '3 clients on TS3 were notified'], self.mike.message_history)
+
+    def test_cmd_calladmin_with_expired_staff_presence(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.p.targets[0].set_presence([{'clid': 1}], time.time() - 3600)
+        when(self.p).send_teamspeak_message(self.p.patterns['p3'] % ('Mike', 'Test Server', 'test reason')).thenReturn(True)
+        when(self.p).send_irc_message(self.p.patterns['i3'] % (RESET, MAGENTA, RESET, ORANGE, 'Mike', RESET, 'Test Server', ORANGE, 'test reason')).thenReturn(True)
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!calladmin test reason")
+        # THEN
+        self.assertListEqual(['Admin request sent: an admin will connect as soon as possible'], self.mike.message_history)
+
+    def test_classify_reason(self):
+        self.assertIsNone(self.p.settings['classifier'].classify('test reason'))
+        self.assertIsNone(self.p.settings['classifier'].classify('he is a hacker'))
+        self.assertEqual('spam', self.p.settings['classifier'].classify('stop SPAMMING')['name'])
+        self.assertEqual('cheating', self.p.settings['classifier'].classify('Mike is hacking')['name'])
+        self.assertEqual('cheating', self.p.settings['classifier'].classify('spam and aimbot')['name'])
+        # overlapping matches: the lower priority category must not hide the higher priority one
+        griefing = {'name': 'griefing', 'patterns': [r'\bteam kill\b'], 'priority': 0}
+        cheating = {'name': 'cheating', 'patterns': [r'kill'], 'priority': 10}
+        for categories in ([griefing, cheating], [cheating, griefing]):
+            classifier = ReasonClassifier(categories)
+            self.assertEqual('cheating', classifier.classify('he keeps doing team kill')['name'])
+
+    def test_cmd_calladmin_with_category(self):
+        # GIVEN
+        self.mike.connects('1')
+        when(self.p).send_teamspeak_message(self.p.patterns['p4'] % ('CHEATING', 'Mike', 'Test Server', 'Bill uses an aimbot'),
+                                            {'msg_groupid': 9, 'msg_mode': 'group'}).thenReturn(True)
+        when(self.p).send_irc_message(self.p.patterns['i4'] % (RESET, MAGENTA, RESET, RED, 'CHEATING', RESET, ORANGE, 'Mike', RESET, 'Test Server', ORANGE, 'Bill uses an aimbot')).thenReturn(False)
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!calladmin Bill uses an aimbot")
+        # THEN
+        self.assertListEqual(['Admin request sent: an admin will connect as soon as possible'], self.mike.message_history)
+        self.assertEqual('cheating', self.p.adminRequest['category']['name'])
+
+    def test_cmd_calladmin_with_category_priority(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.p.adminRequest = { 'client': self.mike, 'reason': 'test reason', 'time': int(time.time()) - 600 }
+        when(self.p).send_teamspeak_message(self.p.patterns['p4'] % ('CHEATING', 'Mike', 'Test Server', 'wallhack'),
+                                            {'msg_groupid': 9, 'msg_mode': 'group'}).thenReturn(True)
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!calladmin wallhack")
+        self.mike.says("!calladmin wallhack")
+        # THEN
+        self.assertListEqual(['Admin request sent: an admin will connect as soon as possible',
+                              'Admin request aborted: already sent 0 seconds ago'], self.mike.message_history)
+
+    def test_cmd_calladmin_lower_priority_within_active_treshold(self):
+        # GIVEN
+        self.mike.connects('1')
+        cheating = [x for x in self.p.settings['categories'] if x['name'] == 'cheating'][0]
+        request = { 'client': self.mike, 'reason': 'wallhack', 'time': int(time.time()) - 100, 'category': cheating }
+        self.p.adminRequest = request
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!calladmin stop spamming")
+        # THEN
+        self.assertListEqual(['Admin request aborted: already sent 1 minute ago'], self.mike.message_history)
+        self.assertIs(request, self.p.adminRequest)
+
+    def test_cmd_calladmin_after_dismiss(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.p.send_teamspeak_message = Mock(return_value=True)
+        self.mike.says("!calladmin test reason")
+        self.p.onReply(b3.events.Event(self.p.replyEvent, {'command': 'dismiss', 'name': 'Fenix', 'text': 'false report'}))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!calladmin test reason")
+        # THEN
+        self.assertListEqual(['Admin request aborted: already sent 0 seconds ago'], self.mike.message_history)
+        self.assertEqual(1, self.p.send_teamspeak_message.call_count)
+        self.assertIsNone(self.p.adminRequest)
+
+    def test_get_teamspeak_clients_by_group(self):
+        # GIVEN
+        sq = Mock()
+        sq.command.return_value = [{'clid': 1, 'client_type': 0, 'client_servergroups': 6},
+                                   {'clid': 2, 'client_type': 0, 'client_servergroups': u'8,6'},
+                                   {'clid': 3, 'client_type': 0, 'client_servergroups': 8},
+                                   {'clid': 4, 'client_type': 1, 'client_servergroups': 6}]
+        # WHEN
+        clients = self.p.get_teamspeak_clients(sq, 6)
+        # THEN
+        sq.command.assert_called_once_with('clientlist', option=['groups'])
+        self.assertListEqual([1, 2], [x['clid'] for x in clients])
+
+    ####################################################################################################################
+    ##                                                                                                                ##
+    ##  TEST CMD CALLADMINRELOAD                                                                                      ##
+    ##                                                                                                                ##
+    ####################################################################################################################
+
+    def test_cmd_calladminreload_keeps_request_and_session(self):
+        # GIVEN
+        self.fenix.connects('3')
+        self.p.adminRequest = { 'client': self.mike, 'reason': 'test reason', 'time': int(time.time()) - 60 }
+        settings = self.p.settings
+        teamspeak = self.p.targets[0].session
+        self.conf.set('settings', 'treshold', '60')
+        # WHEN
+        self.fenix.clearMessageHistory()
+        self.fenix.says("!calladminreload")
+        # THEN
+        self.assertListEqual(['Configuration reloaded'], self.fenix.message_history)
+        self.assertIsNot(settings, self.p.settings)
+        self.assertEqual(3600, settings['treshold'])
+        self.assertEqual(60, self.p.settings['treshold'])
+        self.assertIs(teamspeak, self.p.targets[0].session)
+        self.assertIsNotNone(self.p.adminRequest)
+
+    def test_cmd_calladminreload_rebuilds_changed_parts(self):
+        # GIVEN
+        self.fenix.connects('3')
+        teamspeak = self.p.targets[0].session
+        self.conf.set('teamspeak', 'ip', '127.0.0.2')
+        self.conf.set('teamspeak', 'msg_groupid', '6')
+        # WHEN
+        self.fenix.says("!calladminreload")
+        # THEN
+        target = self.p.targets[0]
+        self.assertIsNot(teamspeak, target.session)
+        self.assertEqual(target._send_group_message, target.send)
+
+    def test_cmd_calladminreload_adds_and_removes_targets(self):
+        # GIVEN
+        self.fenix.connects('3')
+        self.conf.add_section('teamspeak:staff')
+        self.conf.set('teamspeak:staff', 'serverid', '2')
+        self.fenix.says("!calladminreload")
+        teamspeak = self.p.targets[0].session
+        # WHEN
+        self.conf.remove_section('teamspeak:staff')
+        self.fenix.says("!calladminreload")
+        # THEN
+        self.assertListEqual(['teamspeak'], [x.name for x in self.p.targets])
+        self.assertIs(teamspeak, self.p.targets[0].session)
+
+    ####################################################################################################################
+    ##                                                                                                                ##
+    ##  TEST CMD CALLADMINPROFILE                                                                                     ##
+    ##                                                                                                                ##
+    ####################################################################################################################
+
+    def test_cmd_calladminprofile_on_off(self):
+        # GIVEN
+        self.fenix.connects('3')
+        # WHEN
+        self.fenix.clearMessageHistory()
+        self.fenix.says("!calladminprofile on")
+        # THEN
+        self.assertListEqual(['Profiler started'], self.fenix.message_history)
+        self.assertTrue(hasattr(self.adminPlugin._commands['calladmin'].func, 'profiled'))
+        self.assertTrue(all(hasattr(x, 'profiled') for hooks in self.p.eventmap.values() for x in hooks))
+        # WHEN
+        self.fenix.clearMessageHistory()
+        self.fenix.says("!calladminprofile off")
+        # THEN
+        self.assertListEqual(['Profiler stopped: type !calladminprofile dump to save collected data'], self.fenix.message_history)
+        self.assertFalse(hasattr(self.adminPlugin._commands['calladmin'].func, 'profiled'))
+        self.assertFalse(any(hasattr(x, 'profiled') for hooks in self.p.eventmap.values() for x in hooks))
+
+    def test_cmd_calladminprofile_dump(self):
+        # GIVEN
+        tmpdir = tempfile.mkdtemp()
+        self.p.settings['profile_file'] = os.path.join(tmpdir, 'calladmin.prof')
+        self.fenix.connects('3')
+        self.fenix.says("!calladminprofile on")
+        self.mike.connects('1')
+        self.mike.says("!calladmin")
+        self.fenix.says("!calladminprofile off")
+        # WHEN
+        self.fenix.clearMessageHistory()
+        self.fenix.says("!calladminprofile dump")
+        # THEN
+        try:
+            self.assertListEqual(['Profiling data saved: %s' % self.p.settings['profile_file']], self.fenix.message_history)
+            self.assertTrue(os.path.isfile(self.p.settings['profile_file']))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_cmd_calladminprofile_dump_while_running(self):
+        # GIVEN
+        self.fenix.connects('3')
+        self.fenix.says("!calladminprofile on")
+        self.mike.connects('1')
+        self.mike.says("!calladmin")
+        # WHEN
+        self.fenix.clearMessageHistory()
+        self.fenix.says("!calladminprofile dump")
+        self.fenix.says("!calladminprofile off")
+        # THEN
+        self.assertListEqual(['Profiler is on: type !calladminprofile off before saving collected data',
+                              'Profiler stopped: type !calladminprofile dump to save collected data'],
+                             self.fenix.message_history)
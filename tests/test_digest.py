@@ -0,0 +1,155 @@
+#
+# Calladmin Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import b3.events
+import random
+import unittest2
+
+from mock import Mock
+from textwrap import dedent
+from tests import CalladminTestCase
+from tests import logging_disabled
+from calladmin import CalladminPlugin
+from calladmin import P2Quantile
+from calladmin import RollingCounter
+from b3.config import CfgConfigParser
+
+
+class Test_statistics(unittest2.TestCase):
+
+    def test_rolling_counter(self):
+        # GIVEN
+        counter = RollingCounter(60, 60)
+        # WHEN
+        counter.add(0)
+        counter.add(1800)
+        counter.add(3599)
+        # THEN
+        self.assertEqual(3, counter.count(3599))
+        self.assertEqual(2, counter.count(3600))
+        self.assertEqual(1, counter.count(5400))
+        self.assertEqual(0, counter.count(100000))
+
+    def test_p2_median(self):
+        # GIVEN
+        values = range(1, 1002)
+        random.Random(2026).shuffle(values)
+        estimator = P2Quantile(0.5)
+        # WHEN
+        for x in values:
+            estimator.add(x)
+        # THEN
+        self.assertAlmostEqual(501, estimator.value(), delta=25)
+
+    def test_p2_median_few_values(self):
+        # GIVEN
+        estimator = P2Quantile(0.5)
+        # WHEN
+        for x in (30, 10, 20):
+            estimator.add(x)
+        # THEN
+        self.assertEqual(20, estimator.value())
+
+
+class Test_digest(CalladminTestCase):
+
+    def setUp(self):
+        CalladminTestCase.setUp(self)
+        self.conf = CfgConfigParser()
+        self.conf.loadFromString(dedent(r"""
+            [teamspeak]
+            ip: 127.0.0.1
+            port: 10011
+            serverid: 1
+            username: fakeusername
+            password: fakepassword
+            msg_groupid: -1
+
+            [settings]
+            treshold: 0
+            useirc: no
+
+            [digest]
+            interval: 60
+            channelid: 7
+
+            [commands]
+            calladmin: user
+        """))
+
+        self.p = CalladminPlugin(self.console, self.conf)
+        self.p.onLoadConfig()
+        self.p.onStartup()
+
+        with logging_disabled():
+            from b3.fake import FakeClient
+
+        self.mike = FakeClient(console=self.console, name="Mike", guid="mikeguid", groupBits=1)
+        self.bill = FakeClient(console=self.console, name="Bill", guid="billguid", groupBits=16)
+
+    def test_digest_posted(self):
+        # GIVEN
+        self.p.send_teamspeak_message = Mock(return_value=True)
+        self.mike.connects('1')
+        self.mike.says('!calladmin first')
+        self.mike.says('!calladmin second')
+        self.bill.connects('2')
+        self.bill.auth()
+        self.p.lastDigest -= 3600
+        # WHEN
+        self.p.update_digest()
+        # THEN
+        self.p.send_teamspeak_message.assert_called_with(
+            '[B][ADMIN REQUESTS DIGEST][/B] [B]Test Server[/B] : [B]2[/B] in the last hour, [B]2[/B] in the last day, '
+            '[B]1[/B] unanswered, median time to admin arrival: [B]0 seconds[/B]',
+            {'msg_mode': 'channel', 'msg_channelid': 7})
+
+    def test_acknowledged_request_arrival(self):
+        # GIVEN
+        self.p.send_teamspeak_message = Mock(return_value=True)
+        self.mike.connects('1')
+        self.mike.says('!calladmin help')
+        # WHEN
+        self.p.onReply(b3.events.Event(self.p.replyEvent, {'command': 'ack', 'name': 'Fenix', 'text': ''}))
+        self.bill.connects('2')
+        self.bill.auth()
+        # THEN
+        summary = self.p.stats.summary(60)
+        self.assertEqual(0, summary['unanswered'])
+        self.assertEqual(0, summary['median'])
+        self.assertIsNone(self.p.ackRequest)
+
+    def test_dismissed_request_unanswered(self):
+        # GIVEN
+        self.p.send_teamspeak_message = Mock(return_value=True)
+        self.mike.connects('1')
+        self.mike.says('!calladmin help')
+        # WHEN
+        self.p.onReply(b3.events.Event(self.p.replyEvent, {'command': 'dismiss', 'name': 'Fenix', 'text': ''}))
+        # THEN
+        summary = self.p.stats.summary(60)
+        self.assertEqual(1, summary['unanswered'])
+        self.assertIsNone(summary['median'])
+
+    def test_digest_not_posted_before_interval(self):
+        # GIVEN
+        self.p.send_teamspeak_message = Mock()
+        # WHEN
+        self.p.update_digest()
+        # THEN
+        self.assertFalse(self.p.send_teamspeak_message.called)
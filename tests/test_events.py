@@ -18,6 +18,8 @@
 
 from mock import Mock
 from mock import call
+from mockito import when
+from b3.cvar import Cvar
 from textwrap import dedent
 from tests import CalladminTestCase
 from tests import logging_disabled
@@ -93,3 +95,112 @@ class Test_commands(CalladminTestCase):
         # THEN
         self.p.send_teamspeak_message.assert_has_calls([call('[B][ADMIN REQUEST][/B] [B]Mike[/B] disconnected from [B]Test Server[/B]')])
         self.assertIsNone(self.p.adminRequest)
+
+    ####################################################################################################################
+    ##                                                                                                                ##
+    ##  TEST HOSTNAME                                                                                                 ##
+    ##                                                                                                                ##
+    ####################################################################################################################
+
+    def test_hostname_not_resolved_on_startup(self):
+        self.assertIsNone(self.p.hostname)
+
+    def test_hostname_resolved_on_first_use(self):
+        # WHEN
+        hostname = self.p.get_hostnames()
+        # THEN
+        self.assertDictContainsSubset({'raw': 'Test Server', 'ts3': 'Test Server', 'irc': 'Test Server'}, hostname)
+
+    def test_hostname_refreshed_on_change(self):
+        # GIVEN
+        self.p.get_hostnames()
+        self.console.game.sv_hostname = '^1New ^7Server'
+        # WHEN
+        self.p.update_hostname()
+        # THEN
+        self.assertEqual('^1New ^7Server', self.p.get_hostnames()['raw'])
+        self.assertEqual('New Server', self.p.get_hostnames()['ts3'])
+
+    def test_hostname_refreshed_after_ttl(self):
+        # GIVEN
+        self.console.game.sv_hostname = 'Old Name'
+        self.p.get_hostnames()
+        when(self.console).getCvar('sv_hostname').thenReturn(Cvar(name='sv_hostname', value='New Name'))
+        self.p.hostname['time'] -= self.p.settings['hostname_ttl']
+        # WHEN
+        self.p.update_hostname()
+        self.p.update_hostname()
+        # THEN
+        self.assertEqual('New Name', self.p.get_hostnames()['raw'])
+
+    ####################################################################################################################
+    ##                                                                                                                ##
+    ##  TEST PLAYER ACTIVITY                                                                                          ##
+    ##                                                                                                                ##
+    ####################################################################################################################
+
+    def test_activity_recorded(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.mike.says('hello there')
+        self.mike.says('!help')
+        self.mike.team = 2
+        self.mike.kills(self.bill)
+        # THEN
+        self.assertListEqual([('say', 'hello there'), ('team', 'red'), ('kill', 'Bill')],
+                             [(x.kind, x.text) for x in self.p.activity.get(self.mike)])
+        self.assertListEqual([('killed by', 'Mike')], [(x.kind, x.text) for x in self.p.activity.get(self.bill)])
+
+    def test_activity_capped(self):
+        # GIVEN
+        self.conf.set('settings', 'activity_size', '2')
+        self.conf.set('settings', 'activity_players', '1')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        for i in range(5):
+            self.mike.says('line %s' % i)
+        self.bill.says('hi')
+        # THEN
+        self.assertEqual(1, len(self.p.activity))
+        self.assertListEqual([], self.p.activity.get(self.mike))
+        self.assertListEqual(['hi'], [x.text for x in self.p.activity.get(self.bill)])
+
+    def test_activity_attached_to_request(self):
+        # GIVEN
+        with logging_disabled():
+            from b3.fake import FakeClient
+        joe = FakeClient(console=self.console, name="Joe", guid="joeguid", groupBits=1)
+        self.p.send_teamspeak_message = Mock()
+        self.mike.connects('1')
+        joe.connects('2')
+        joe.says('noob')
+        # WHEN
+        self.mike.says('!calladmin joe is insulting')
+        # THEN
+        self.p.send_teamspeak_message.assert_has_calls([call('[B][ADMIN REQUEST][/B] [B]Mike[/B] requested an admin on '
+                                                             '[B]Test Server[/B] : [B]joe is insulting[/B] - '
+                                                             '[B]Joe[/B]: say "noob" 0s ago')])
+
+    def test_activity_attached_within_message_length(self):
+        # GIVEN
+        with logging_disabled():
+            from b3.fake import FakeClient
+        self.p.send_teamspeak_message = Mock()
+        self.mike.connects('1')
+        names = ['Alpha', 'Bravo', 'Charlie', 'Delta', 'Echo']
+        for i, name in enumerate(names):
+            player = FakeClient(console=self.console, name=name, guid='guid%s' % i, groupBits=1)
+            player.connects(str(i + 2))
+            for j in range(3):
+                player.says('%s is writing a rather long line of chat number %s to fill the buffer' % (name, j))
+        # WHEN
+        self.mike.says('!calladmin %s are insulting' % ' '.join(names))
+        # THEN
+        message = self.p.send_teamspeak_message.call_args[0][0]
+        self.assertLessEqual(len(message.encode('utf-8')), 1024)
+        self.assertIn(' - [B]', message)
+        self.assertLessEqual(message.count(' - [B]'), self.p.activity_named)
@@ -0,0 +1,421 @@
+#
+# Calladmin Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import shutil
+import tempfile
+import time
+import threading
+import unittest2
+
+from mockito import unstub
+from textwrap import dedent
+from tests import CalladminTestCase
+from tests import logging_disabled
+from tests.replay import ServerQueryReplay
+from calladmin import CalladminPlugin
+from calladmin import ServerQuery
+from calladmin import ServerQueryCapture
+from calladmin import TeamspeakSession
+from calladmin import TS3Error
+from b3.config import CfgConfigParser
+
+CLIENTLIST = 'clid=1 cid=1 client_database_id=2 client_nickname=Fenix client_type=0 client_servergroups=6|' \
+             'clid=2 cid=1 client_database_id=3 client_nickname=Mike client_type=0 client_servergroups=8|' \
+             'clid=3 cid=1 client_database_id=1 client_nickname=B3 client_type=1 client_servergroups=2\n\r' \
+             'error id=0 msg=ok\n\r'
+
+OK = 'error id=0 msg=ok\n\r'
+
+
+def write_capture(path, exchanges):
+    """
+    Write a capture file containing the given (command, reply) exchanges.
+    """
+    capture = ServerQueryCapture(path)
+    capture.record(0.0, 0.0, None, ServerQueryReplay.greeting)
+    for command, reply in exchanges:
+        capture.record(0.0, 0.0, command, reply)
+
+
+class Test_capture(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'replay.ts3capture')
+        write_capture(self.path, [('login client_login_name=b3 client_login_password=secret\n', OK),
+                                  ('use sid=1\n', OK),
+                                  ('clientlist -groups\n', CLIENTLIST)])
+        self.replay = ServerQueryReplay(ServerQueryCapture.load(self.path), speed=0)
+        self.replay.start()
+
+    def tearDown(self):
+        self.replay.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_sanitize(self):
+        self.assertEqual('login client_login_name=b3 client_login_password=***',
+                         ServerQueryCapture.sanitize('login client_login_name=b3 client_login_password=secret\n'))
+        self.assertEqual('login b3 ***', ServerQueryCapture.sanitize('login b3 secret\n'))
+        self.assertEqual('use sid=1', ServerQueryCapture.sanitize('use sid=1\n'))
+
+    def test_capture_replay_roundtrip(self):
+        # GIVEN
+        path = os.path.join(self.tmpdir, 'roundtrip.ts3capture')
+        sq = ServerQuery(*self.replay.address, capture=ServerQueryCapture(path))
+        # WHEN
+        sq.connect()
+        sq.command('login', {'client_login_name': 'b3', 'client_login_password': 'another'})
+        sq.command('use', {'sid': 1})
+        clientlist = sq.command('clientlist', option=['groups'])
+        sq.disconnect()
+        # THEN
+        self.assertListEqual([u'Fenix', u'Mike', u'B3'], [x['client_nickname'] for x in clientlist])
+        records = ServerQueryCapture.load(path)
+        self.assertIsNone(records[0]['c'])
+        self.assertEqual(ServerQueryReplay.normalize('login client_login_name=b3 client_login_password=***'),
+                         ServerQueryReplay.normalize(records[1]['c']))
+        self.assertListEqual(['use sid=1', 'clientlist -groups'], [x['c'] for x in records[2:]])
+        self.assertNotIn('another', open(path).read())
+        self.assertEqual(CLIENTLIST.strip(), records[3]['r'].strip())
+
+
+class Test_replay(CalladminTestCase):
+
+    def setUp(self):
+        CalladminTestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'replay.ts3capture')
+        write_capture(path, [('login client_login_name=b3 client_login_password=secret\n', OK),
+                             ('use sid=1\n', OK),
+                             ('clientlist -groups\n', CLIENTLIST),
+                             ('sendtextmessage target=1 msg=test targetmode=1\n', OK)])
+        self.replay = ServerQueryReplay(ServerQueryCapture.load(path), speed=0)
+        ip, port = self.replay.start()
+
+        self.conf = CfgConfigParser()
+        self.conf.loadFromString(dedent(r"""
+            [teamspeak]
+            ip: %s
+            port: %s
+            serverid: 1
+            username: b3
+            password: secret
+            msg_groupid: 6
+
+            [settings]
+            treshold: 3600
+            useirc: no
+        """ % (ip, port)))
+
+        self.p = CalladminPlugin(self.console, self.conf)
+        self.p.onLoadConfig()
+
+    def tearDown(self):
+        self.replay.stop()
+        shutil.rmtree(self.tmpdir)
+        CalladminTestCase.tearDown(self)
+
+    def test_personal_teamspeak_message(self):
+        # WHEN
+        sent = self.p.send_teamspeak_message('test')
+        # THEN
+        self.assertTrue(sent)
+        self.assertEqual(1, self.replay.served['clientlist'])
+        self.assertEqual(1, self.replay.served['sendtextmessage'])
+
+
+class Test_multiple_targets(CalladminTestCase):
+
+    def setUp(self):
+        CalladminTestCase.setUp(self)
+        records = [{'c': 'login', 'd': 0.0, 'r': OK},
+                   {'c': 'use', 'd': 0.0, 'r': OK},
+                   {'c': 'clientlist -groups', 'd': 0.0, 'r': CLIENTLIST},
+                   {'c': 'sendtextmessage', 'd': 0.0, 'r': OK}]
+        self.main = ServerQueryReplay(records, speed=0)
+        self.staff = ServerQueryReplay(records, speed=0)
+        ip, port = self.main.start()
+        self.staff.start()
+
+        self.conf = CfgConfigParser()
+        self.conf.loadFromString(dedent(r"""
+            [teamspeak]
+            ip: %s
+            port: %s
+            serverid: 1
+            username: b3
+            password: secret
+            msg_groupid: 6
+
+            [teamspeak:staff]
+            port: %s
+            msg_groupid: -1
+
+            [teamspeak:broken]
+            port: 1
+
+            [settings]
+            treshold: 3600
+            useirc: no
+        """ % (ip, port, self.staff.address[1])))
+
+        self.p = CalladminPlugin(self.console, self.conf)
+        self.p.onLoadConfig()
+
+    def tearDown(self):
+        self.main.stop()
+        self.staff.stop()
+        CalladminTestCase.tearDown(self)
+
+    def test_targets_inherit_main_settings(self):
+        self.assertListEqual(['teamspeak', 'teamspeak:staff', 'teamspeak:broken'], [x.name for x in self.p.targets])
+        self.assertEqual(self.main.address[0], self.p.targets[1].settings['ip'])
+        self.assertEqual('secret', self.p.targets[1].settings['password'])
+        self.assertEqual(-1, self.p.targets[1].settings['msg_groupid'])
+        self.assertEqual(6, self.p.targets[2].settings['msg_groupid'])
+
+    def test_message_delivered_to_all_reachable_targets(self):
+        # WHEN
+        sent = self.p.send_teamspeak_message('test')
+        # THEN
+        self.assertTrue(sent)
+        self.assertEqual(1, self.main.served['clientlist'])
+        self.assertEqual(1, self.main.served['sendtextmessage'])
+        self.assertNotIn('clientlist', self.staff.served)
+        self.assertEqual(1, self.staff.served['sendtextmessage'])
+
+
+class Test_delivery_modes(CalladminTestCase):
+
+    def setUp(self):
+        CalladminTestCase.setUp(self)
+        self.replay = ServerQueryReplay([{'c': 'login', 'd': 0.0, 'r': OK},
+                                         {'c': 'use', 'd': 0.0, 'r': OK},
+                                         {'c': 'whoami', 'd': 0.0, 'r': 'virtualserver_id=1 client_id=3\n\r' + OK},
+                                         {'c': 'clientmove', 'd': 0.0, 'r': OK},
+                                         {'c': 'clientlist -groups', 'd': 0.0, 'r': CLIENTLIST},
+                                         {'c': 'clientpoke', 'd': 0.0, 'r': OK},
+                                         {'c': 'sendtextmessage', 'd': 0.0, 'r': OK}], speed=0)
+        self.replay.start()
+
+    def tearDown(self):
+        self.replay.stop()
+        CalladminTestCase.tearDown(self)
+
+    def init(self, options):
+        self.conf = CfgConfigParser()
+        self.conf.loadFromString(dedent(r"""
+            [teamspeak]
+            ip: %s
+            port: %s
+            serverid: 1
+            username: b3
+            password: secret
+            %s
+
+            [settings]
+            treshold: 3600
+            useirc: no
+        """) % (self.replay.address[0], self.replay.address[1], options))
+        self.p = CalladminPlugin(self.console, self.conf)
+        self.p.onLoadConfig()
+
+    def test_mode_implied_by_group(self):
+        # WHEN
+        self.init('msg_groupid: 6')
+        # THEN
+        self.assertEqual('group', self.p.settings['msg_mode'])
+
+    def test_mode_fallback_without_channel(self):
+        # WHEN
+        self.init('msg_mode: channel')
+        # THEN
+        self.assertEqual('global', self.p.settings['msg_mode'])
+
+    def test_listen_requires_group(self):
+        # WHEN
+        self.init('listen: yes')
+        # THEN
+        self.assertFalse(self.p.settings['listen'])
+
+    def test_channel_message(self):
+        # GIVEN
+        self.init('msg_mode: channel\nmsg_channelid: 5')
+        # WHEN
+        sent = self.p.send_teamspeak_message('test')
+        # THEN
+        self.assertTrue(sent)
+        self.assertEqual(1, self.replay.served['clientmove'])
+        self.assertEqual(1, self.replay.served['sendtextmessage'])
+        self.assertNotIn('clientlist', self.replay.served)
+
+    def test_poke_message(self):
+        # GIVEN
+        self.init('msg_mode: poke\nmsg_groupid: 8')
+        # WHEN
+        sent = self.p.send_teamspeak_message('x' * 200)
+        # THEN
+        self.assertTrue(sent)
+        self.assertEqual(1, self.replay.served['clientlist'])
+        self.assertEqual(1, self.replay.served['clientpoke'])
+
+    def test_pipeline(self):
+        # GIVEN
+        sq = ServerQuery(*self.replay.address)
+        sq.connect()
+        sq.command('login', {'client_login_name': 'b3', 'client_login_password': 'secret'})
+        # WHEN
+        results = sq.pipeline([('clientpoke', {'clid': 1, 'msg': 'test'}),
+                               ('unknowncommand',),
+                               ('clientlist', None, ['groups'])])
+        sq.disconnect()
+        # THEN
+        self.assertEqual({}, results[0])
+        self.assertEqual(256, results[1].code)
+        self.assertListEqual([u'Fenix', u'Mike', u'B3'], [x['client_nickname'] for x in results[2]])
+
+
+class Test_listener(CalladminTestCase):
+
+    notify = 'notifytextmessage targetmode=3 msg=%s invokerid=%s invokername=%s invokeruid=abc\n\r'
+
+    def setUp(self):
+        CalladminTestCase.setUp(self)
+        self.replay = None
+        with logging_disabled():
+            from b3.fake import FakeClient
+        self.mike = FakeClient(console=self.console, name="Mike", guid="mikeguid", groupBits=1)
+
+    def tearDown(self):
+        self.p.stop_listener()
+        self.replay.stop()
+        CalladminTestCase.tearDown(self)
+
+    def create_plugin(self, *notifications):
+        """
+        Create the plugin listening on a replay server which pushes the given (msg, invokerid, invokername) notifications.
+        """
+        notify = ''.join([self.notify % x for x in notifications])
+        self.replay = ServerQueryReplay([{'c': 'login', 'd': 0.0, 'r': OK},
+                                         {'c': 'use', 'd': 0.0, 'r': OK},
+                                         {'c': 'whoami', 'd': 0.0, 'r': 'virtualserver_id=1 client_id=3\n\r' + OK},
+                                         {'c': 'clientlist -groups', 'd': 0.0, 'r': CLIENTLIST},
+                                         {'c': 'servernotifyregister event=textprivate', 'd': 0.0, 'r': OK},
+                                         {'c': 'servernotifyregister event=textchannel', 'd': 0.0, 'r': OK},
+                                         {'c': 'servernotifyregister event=textserver', 'd': 0.0,
+                                          'r': OK + notify}], speed=0)
+        ip, port = self.replay.start()
+
+        self.conf = CfgConfigParser()
+        self.conf.loadFromString(dedent(r"""
+            [teamspeak]
+            ip: %s
+            port: %s
+            serverid: 1
+            username: b3
+            password: secret
+            msg_groupid: 6
+            listen: yes
+
+            [settings]
+            treshold: 3600
+            useirc: no
+        """ % (ip, port)))
+
+        self.p = CalladminPlugin(self.console, self.conf)
+        self.p.onLoadConfig()
+
+    def start_listener(self):
+        """
+        Start the listener and wait for the pending admin request to be resolved.
+        """
+        self.p.onStartup()
+        for _ in range(50):
+            if self.p.adminRequest is None:
+                break
+            threading.Event().wait(0.1)
+
+    def test_ack_resolves_request(self):
+        # GIVEN
+        self.create_plugin(('hello', 1, 'Fenix'), ('!ack\\s5\\sminutes', 1, 'Fenix'))
+        self.mike.connects('1')
+        self.p.adminRequest = {'client': self.mike, 'reason': 'test reason', 'time': 0}
+        # WHEN
+        self.start_listener()
+        # THEN
+        self.assertIsNone(self.p.adminRequest)
+        self.assertListEqual(['[ACK] Fenix is on the way: 5 minutes'], self.mike.message_history)
+        self.assertEqual(3, self.replay.served['servernotifyregister'])
+
+    def test_reply_from_outside_staff_group_ignored(self):
+        # GIVEN
+        self.create_plugin(('!dismiss', 2, 'Mike'), ('!dismiss', 3, 'B3'), ('!ack', 1, 'Fenix'))
+        self.mike.connects('1')
+        self.p.adminRequest = {'client': self.mike, 'reason': 'test reason', 'time': 0}
+        # WHEN
+        self.start_listener()
+        # THEN
+        self.assertIsNone(self.p.adminRequest)
+        self.assertListEqual(['[ACK] Fenix is on the way'], self.mike.message_history)
+
+
+class Test_session(unittest2.TestCase):
+
+    def setUp(self):
+        # reply timeouts are computed by telnetlib using the real clock
+        unstub(time)
+        self.replay = ServerQueryReplay([{'c': 'login', 'd': 0.0, 'r': OK},
+                                         {'c': 'use', 'd': 0.0, 'r': OK},
+                                         {'c': 'clientlist -groups', 'd': 0.5, 'r': CLIENTLIST},
+                                         {'c': 'whoami', 'd': 0.0, 'r': 'virtualserver_id=1 client_id=9\n\r' + OK},
+                                         {'c': 'clientmove', 'd': 0.0,
+                                          'r': 'error id=770 msg=already\\smember\\sof\\schannel\n\r'},
+                                         {'c': 'sendtextmessage', 'd': 0.0, 'r': OK}])
+        self.replay.start()
+        self.session = TeamspeakSession(self.replay.address[0], self.replay.address[1], 1, 'b3', 'secret')
+
+    def tearDown(self):
+        self.session.close()
+        self.replay.stop()
+
+    def test_session_dropped_on_reply_timeout(self):
+        # GIVEN
+        self.session.command('whoami')
+        self.session._query._timeout = 0.1
+        # WHEN
+        with self.assertRaises(TS3Error) as context:
+            self.session.command('clientlist', option=['groups'])
+        whoami = self.session.command('whoami')
+        # THEN
+        self.assertEqual(12, context.exception.code)
+        self.assertEqual(9, whoami['client_id'])
+        self.assertEqual(2, self.replay.served['login'])
+
+    def test_error_reply_does_not_wait_for_timeout(self):
+        # GIVEN
+        self.session = TeamspeakSession(self.replay.address[0], self.replay.address[1], 1, 'b3', 'secret', channelid=5)
+        start = time.time()
+        # WHEN
+        self.session.channel_command(5, 'sendtextmessage', {'targetmode': 2, 'target': 5, 'msg': 'test'})
+        self.session._joined = None
+        self.session.channel_command(5, 'sendtextmessage', {'targetmode': 2, 'target': 5, 'msg': 'test'})
+        # THEN
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(2, self.replay.served['clientmove'])
+        self.assertEqual(2, self.replay.served['sendtextmessage'])
@@ -0,0 +1,189 @@
+#
+# Calladmin Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import gc
+import os
+import time
+import random
+import logging
+import threading
+import functools
+
+from mockito import unstub
+from timeit import default_timer
+from textwrap import dedent
+from tests import CalladminTestCase
+from tests import logging_disabled
+from tests.replay import ServerQueryReplay
+from calladmin import CalladminPlugin
+from b3.config import CfgConfigParser
+
+# defaults are generous so that the test passes on slow machines too: override them from the
+# environment to tighten the budgets, i.e: CALLADMIN_STRESS_RATE=1000 CALLADMIN_STRESS_MAX_STALL=0.1 nosetests
+PLAYERS = int(os.environ.get('CALLADMIN_STRESS_PLAYERS', 64))
+RATE = float(os.environ.get('CALLADMIN_STRESS_RATE', 100))                # simulated events per second
+DURATION = float(os.environ.get('CALLADMIN_STRESS_DURATION', 2))          # seconds
+LATENCY = float(os.environ.get('CALLADMIN_STRESS_LATENCY', 0.02))         # seconds added to every TS3 reply
+MAX_STALL = float(os.environ.get('CALLADMIN_STRESS_MAX_STALL', 2))        # seconds
+MAX_GROWTH = int(os.environ.get('CALLADMIN_STRESS_MAX_GROWTH', 2000))     # objects
+
+OK = 'error id=0 msg=ok\n\r'
+CLIENTLIST = 'clid=1 cid=1 client_database_id=2 client_nickname=Fenix client_type=0 client_servergroups=6|' \
+             'clid=2 cid=1 client_database_id=3 client_nickname=Mike client_type=0 client_servergroups=6,8\n\r' + OK
+
+
+class StressHarness(object):
+
+    def __init__(self, plugin, handlers):
+        """
+        Object constructor.
+        Replace the given plugin handlers with wrappers measuring how long they hold the calling
+        thread: this must happen before the plugin startup so that B3 maps the wrappers.
+        """
+        self.stats = {}
+        for name in handlers:
+            self.stats[name] = {'calls': 0, 'total': 0.0, 'max': 0.0}
+            setattr(plugin, name, self.timed(name, getattr(plugin, name)))
+
+    def timed(self, name, func):
+        """
+        Return a wrapper of func which records its execution time.
+        """
+        stats = self.stats[name]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = default_timer() - start
+                stats['calls'] += 1
+                stats['total'] += elapsed
+                stats['max'] = max(stats['max'], elapsed)
+
+        return wrapper
+
+    @property
+    def max_stall(self):
+        return max(x['max'] for x in self.stats.values())
+
+    def report(self, events, elapsed, growth):
+        """
+        Return a human readable report of the stress run.
+        """
+        lines = ['%s events in %.2fs (%.1f events/s), object growth: %s' % (events, elapsed, events / elapsed, growth)]
+        for name in sorted(self.stats):
+            x = self.stats[name]
+            lines.append('%-14s calls: %5d - avg: %7.2fms - max: %7.2fms' % (name, x['calls'],
+                         x['total'] * 1000 / x['calls'] if x['calls'] else 0, x['max'] * 1000))
+        return '\n'.join(lines)
+
+
+class Test_stress(CalladminTestCase):
+
+    def setUp(self):
+        CalladminTestCase.setUp(self)
+        # mockito remembers every invocation of a stubbed method: use the real clock
+        unstub(time)
+        self.replay = ServerQueryReplay([{'c': 'clientlist -groups', 'd': 0.0, 'r': CLIENTLIST},
+                                         {'c': 'login', 'd': 0.0, 'r': OK},
+                                         {'c': 'use', 'd': 0.0, 'r': OK},
+                                         {'c': 'sendtextmessage', 'd': 0.0, 'r': OK}], speed=0, latency=LATENCY)
+        ip, port = self.replay.start()
+
+        self.conf = CfgConfigParser()
+        self.conf.loadFromString(dedent(r"""
+            [teamspeak]
+            ip: %s
+            port: %s
+            serverid: 1
+            username: b3
+            password: secret
+            msg_groupid: 6
+
+            [settings]
+            treshold: 3600
+            useirc: no
+
+            [commands]
+            calladmin: user
+        """ % (ip, port)))
+
+        self.p = CalladminPlugin(self.console, self.conf)
+        self.harness = StressHarness(self.p, ('cmd_calladmin', 'onAuth', 'onDisconnect'))
+        self.p.onLoadConfig()
+        self.p.onStartup()
+
+        with logging_disabled():
+            from b3.fake import FakeClient
+
+        # one out of 16 players is an admin (admins leave more often so that requests get delivered)
+        self.players = [FakeClient(console=self.console, name='Player%s' % i, guid='guid%s' % i,
+                                   groupBits=16 if i % 16 == 0 else 1) for i in range(PLAYERS)]
+
+    def tearDown(self):
+        self.replay.stop()
+        CalladminTestCase.tearDown(self)
+
+    def test_event_thread_stall(self):
+        rand = random.Random(2026)
+        pause = threading.Event()
+        connected = set()
+
+        def step():
+            player = rand.choice(self.players)
+            if player not in connected:
+                player.connects(str(self.players.index(player)))
+                player.auth()
+                connected.add(player)
+            elif rand.random() < (0.5 if player.maxLevel >= self.p.adminPlugin._admins_level else 0.2):
+                player.disconnects()
+                connected.discard(player)
+            else:
+                player.says('!calladmin stress test')
+            player.clearMessageHistory()
+
+        with logging_disabled():
+            # warm up (caches, first connection) before taking the memory baseline
+            for _ in range(PLAYERS):
+                step()
+            self.sleep_mock.reset_mock()
+            gc.collect()
+            baseline = len(gc.get_objects())
+
+            events = 0
+            start = default_timer()
+            while default_timer() - start < DURATION:
+                step()
+                events += 1
+                # pace the simulated players to the configured rate
+                delay = start + events / RATE - default_timer()
+                if delay > 0:
+                    pause.wait(delay)
+            elapsed = default_timer() - start
+
+            self.sleep_mock.reset_mock()
+            gc.collect()
+            growth = len(gc.get_objects()) - baseline
+
+        report = self.harness.report(events, elapsed, growth)
+        logging.getLogger('calladmin.stress').info('stress test report\n%s' % report)
+        self.assertGreater(self.harness.stats['cmd_calladmin']['calls'], 0, report)
+        self.assertLessEqual(self.harness.max_stall, MAX_STALL, 'event thread blocked too long\n%s' % report)
+        self.assertLessEqual(growth, MAX_GROWTH, 'memory growth over budget\n%s' % report)